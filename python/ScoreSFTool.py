@@ -3,27 +3,165 @@ Author: George Uttley
 Date: 18/01/22
 """
 
-import ROOT
+import os
 import json
+import math
 from collections import OrderedDict
+from multiprocessing import Pool
 from array import array
-import copy
-ROOT.gROOT.SetBatch(1)
+import numpy as np
+if 'CMSSW_BASE' in os.environ: # assume CMSSW environment
+  from TauPOG.TauIDSFs.helpers import LazyModule
+  from TauPOG.TauIDSFs.sftables import ScoreTable, CubicSpline, ScoreSplineTable
+else:
+  from helpers import LazyModule
+  from sftables import ScoreTable, CubicSpline, ScoreSplineTable
+ROOT = LazyModule('ROOT',setup=lambda ROOT: ROOT.gROOT.SetBatch(1)) # import ROOT only when needed
+
+class Hist1D:
+
+  def __init__(self,name,edges,contents=None,variances=None):
+    """
+    Lightweight histogram in NumPy arrays, with the same parts of the interface as ROOT.TH1D that are used
+    by ScoreSFTool. Contents and variances include the underflow and overflow bin, so bin i runs from
+    edges[i-1] to edges[i] as in ROOT.
+
+    :param name: Name of histogram
+    :param edges: Bin edges
+    :param contents: Bin contents, including underflow and overflow bin
+    :param variances: Bin variances (squared errors), including underflow and overflow bin
+    """
+    self.name = name
+    self.edges = np.array(edges,dtype=float)
+    nbins = len(self.edges)+1
+    self.contents = np.zeros(nbins) if contents is None else np.array(contents,dtype=float)
+    self.variances = np.zeros(nbins) if variances is None else np.array(variances,dtype=float)
+    if self.contents.shape != (nbins,) or self.variances.shape != (nbins,):
+      raise ValueError("Histogram {} with {} bins needs {} contents and variances, including under- and overflow".format(name,nbins-2,nbins))
+
+  @classmethod
+  def FromTH1(cls,hist):
+    """
+    Convert a ROOT 1D histogram, or copy a Hist1D.
+
+    :param hist: ROOT.TH1 or Hist1D
+    :return: Hist1D
+    """
+    if isinstance(hist,cls): return hist.Clone()
+    nbins = hist.GetNbinsX()
+    edges = [hist.GetBinLowEdge(i) for i in range(1,nbins+2)]
+    contents = [hist.GetBinContent(i) for i in range(0,nbins+2)]
+    variances = [hist.GetBinError(i)**2 for i in range(0,nbins+2)]
+    return cls(hist.GetName(),edges,contents,variances)
+
+  def ToTH1(self,name=None):
+    """
+    Convert to ROOT.TH1D, e.g. for plotting or writing to file.
+
+    :param name: Name of ROOT histogram, default: name of this histogram
+    :return: ROOT.TH1D
+    """
+    bins = array('d',self.edges.tolist())
+    hist = ROOT.TH1D(name or self.name,"",len(bins)-1,bins)
+    hist.SetDirectory(0)
+    for i, (content, error) in enumerate(zip(self.contents.tolist(),self.GetErrors().tolist())):
+      hist.SetBinContent(i,content)
+      hist.SetBinError(i,error)
+    return hist
+
+  def Clone(self,name=None):
+    return Hist1D(name or self.name,self.edges,self.contents,self.variances)
+
+  def GetName(self):
+    return self.name
+
+  def GetNbinsX(self):
+    return len(self.edges)-1
+
+  def GetBinLowEdge(self,i):
+    return float(self.edges[i-1])
+
+  def GetBinContent(self,i):
+    return float(self.contents[i])
+
+  def GetBinError(self,i):
+    return float(self.variances[i]**0.5)
+
+  def GetErrors(self):
+    return np.sqrt(self.variances)
+
+  def SetBinContent(self,i,content):
+    self.contents[i] = content
+
+  def SetBinError(self,i,error):
+    self.variances[i] = error**2
+
+  def FindBin(self,x):
+    return int(np.searchsorted(self.edges,x,side='right'))
+
+  def CheckBinning(self,hist):
+    if not np.array_equal(self.edges,hist.edges):
+      raise ValueError("Histograms {} and {} have different binning".format(self.name,hist.name))
+
+  def Multiply(self,hist):
+    """
+    Multiply by another histogram bin by bin, propagating the uncorrelated errors as ROOT.TH1.Multiply.
+
+    :param hist: Hist1D or ROOT.TH1 with the same binning
+    """
+    if not isinstance(hist,Hist1D): hist = Hist1D.FromTH1(hist)
+    self.CheckBinning(hist)
+    self.variances = self.variances*hist.contents**2 + hist.variances*self.contents**2
+    self.contents = self.contents*hist.contents
+
+  def Divide(self,hist):
+    """
+    Divide by another histogram bin by bin, propagating the uncorrelated errors as ROOT.TH1.Divide.
+    Bins with a zero denominator are set to zero.
+
+    :param hist: Hist1D or ROOT.TH1 with the same binning
+    """
+    if not isinstance(hist,Hist1D): hist = Hist1D.FromTH1(hist)
+    self.CheckBinning(hist)
+    denom = hist.contents
+    nonzero = denom != 0
+    safe = np.where(nonzero,denom,1.)
+    self.variances = np.where(nonzero,(self.variances*denom**2 + hist.variances*self.contents**2)/safe**4,0.)
+    self.contents = np.where(nonzero,self.contents/safe,0.)
+
+  def Scale(self,factor):
+    self.contents = self.contents*factor
+    self.variances = self.variances*factor**2
+
+  def Print(self,option=""):
+    print "Hist1D {}: {} bins from {:g} to {:g}".format(self.name,self.GetNbinsX(),self.edges[0],self.edges[-1])
+    if option != "all": return
+    for i, (content, error) in enumerate(zip(self.contents.tolist(),self.GetErrors().tolist())):
+      print " bin {}: content={:g}, error={:g}".format(i,content,error)
 
 class ScoreSFTool:
 
-  def __init__(self):
+  def __init__(self,plot_mode="draw"):
     """                                                                                                 
     **TauPOG.TauIDSFs.ScoreSFTool** contains tau ID score reweighting algorithms                        
                                                                                                         
     Allows for easy movement between data effiencies, mc efficiences and SFs as well as number of       
     operations on each efficiency to be performed. Also contains plotting functions to help 
     visualise the problem.                                                                                        
+
+    Histograms are held as NumPy-backed Hist1D, and only converted to ROOT histograms for plotting and export.
+
+    :param plot_mode: "draw" to draw each plot right away, "none" to skip all plotting (no ROOT canvases),
+                      or "defer" to record the plots and draw them later with RenderPlots
     """ 
+    if plot_mode not in ["draw","none","defer"]:
+      raise ValueError("Plot mode must be either draw, none or defer, got {}".format(plot_mode))
     self.histograms_od = OrderedDict()
     self.spline_od = OrderedDict()
     self.sorted_wp = list()
     self.rebinned_bins = OrderedDict()
+    self.plot_mode = plot_mode
+    self.plot_requests = list()
 
   def CheckType(self,input_type):
     """
@@ -42,12 +180,12 @@ class ScoreSFTool:
     """  
     Input an ordered dictionary of histograms and their type to the algorithm to store in class.
 
-    :param hists: Ordered dictionary of ROOT 1D histograms
+    :param hists: Ordered dictionary of ROOT 1D histograms or Hist1D
     :param input_type: Type of histograms given to algorithm
     """
     if not self.CheckType(input_type): return None
 
-    self.histograms_od[input_type] = copy.deepcopy(hists)
+    self.histograms_od[input_type] = OrderedDict((k,Hist1D.FromTH1(v)) for k,v in hists.items())
     self.GetSortedWPs(hists)
     for k,v in self.histograms_od.iteritems():
       for wp in v.keys():
@@ -102,17 +240,17 @@ class ScoreSFTool:
     if output_type == "mc":
       self.histograms_od["mc"] = OrderedDict()
       for k,v in self.histograms_od["data"].iteritems():
-        self.histograms_od["mc"][k] = copy.deepcopy(v)
+        self.histograms_od["mc"][k] = v.Clone()
         self.histograms_od["mc"][k].Divide(self.histograms_od["sf"][k])
     elif output_type == "data":
       self.histograms_od["data"] = OrderedDict()
       for k,v in self.histograms_od["mc"].iteritems():
-        self.histograms_od["data"][k] = copy.deepcopy(v)
+        self.histograms_od["data"][k] = v.Clone()
         self.histograms_od["data"][k].Multiply(self.histograms_od["sf"][k])
     elif output_type == "sf":
       self.histograms_od["sf"] = OrderedDict()
       for k,v in self.histograms_od["data"].iteritems():
-        self.histograms_od["sf"][k] = copy.deepcopy(v)
+        self.histograms_od["sf"][k] = v.Clone()
         self.histograms_od["sf"][k].Divide(self.histograms_od["mc"][k])
 
   def PrintHistograms(self,print_type=["mc","data","sf"]):
@@ -134,103 +272,103 @@ class ScoreSFTool:
     Scale histograms of a certain type up or down by a single histogram.
 
     :param input_type: Type of histograms to scale
-    :parm hist: Histogram to scale by
+    :parm hist: Histogram to scale by (Hist1D or ROOT 1D histogram)
     :param divide: Set true to divide instead of multiply
     """
+    if not isinstance(hist,Hist1D): hist = Hist1D.FromTH1(hist)
     for k,v in self.histograms_od[input_type].iteritems():
       if not divide:
         self.histograms_od[input_type][k].Multiply(hist)
       else:
         self.histograms_od[input_type][k].Divide(hist)
     
-  def GetHistograms(self,output_type):
+  def GetHistograms(self,output_type,root=False):
     """
     Return ordered dictionary of histograms from class.
 
     :param output_type: Type of histograms to return
+    :param root: Return ROOT.TH1D instead of Hist1D, e.g. to write to file
     :return: Ordered dictionary of histograms
     """
-    return copy.deepcopy(self.histograms_od[output_type])
+    return OrderedDict((k,self.GetHistogram(output_type,k,root=root)) for k in self.histograms_od[output_type])
 
-  def GetHistogram(self,output_type,key):
+  def GetHistogram(self,output_type,key,root=False):
     """                                                                                             
-    Return specific histogram from class.                                             
+    Return copy of specific histogram from class.                                             
                                                                                                     
     :param output_type: Type of histograms to get specific one
     :param key: Name of specific histogram
+    :param root: Return ROOT.TH1D instead of Hist1D, e.g. to write to file
     :return: Histogram requested                                                       
     """
-    return copy.deepcopy(self.histograms_od[output_type][key])
+    hist = self.histograms_od[output_type][key]
+    return hist.ToTH1() if root else hist.Clone()
 
   def ConvertToWPBinnedHistograms(self,rebin_threshold=0.1):
     """                                                                                             
     Convert WP histograms in bins of a variable. To variable histograms in bins of the WP.                                                           
                                                                                                     
     :param rebin_threshold: All WP bins will contain an efficiency greater than this threshold. If
-                            they do not, then it is merged with the adjacent WP bin.
+                            they do not, then it is merged with the adjacent WP bin. Can be a single
+                            value, a list with a value per variable bin, or a dictionary of variable
+                            bin names (e.g. "20.0to25.0") to values.
     """ 
-    temp_histograms_od = OrderedDict()
-    temp_histograms_od["data"] = OrderedDict()
-    temp_histograms_od["mc"] = OrderedDict()
-
     h = list(self.histograms_od["sf"].items())[0][1]
     bins = [[h.GetBinLowEdge(i),h.GetBinLowEdge(i+1)] for i in range(1,h.GetNbinsX()+1)] 
-  
- 
-    # get data efficiencies first
-    eff_bin_data_val = OrderedDict()
-    eff_bin_wp = OrderedDict()
-    for b in bins:
-      bin_name = str(b[0]) + "to" + str(b[1])
-      eff_bin_data_val[bin_name] = list()
-      eff_bin_wp[bin_name] = list()
-      for ind, wp in enumerate(self.sorted_wp):
-        bin_number = self.histograms_od["data"][wp].FindBin((b[0]+b[1])/2)
-        if ind + 1 != len(self.sorted_wp):
-          eff_bin_data_val[bin_name].append(self.histograms_od["data"][wp].GetBinContent(bin_number) - self.histograms_od["data"][self.sorted_wp[ind+1]].GetBinContent(bin_number))
-          eff_bin_wp[bin_name].append(self.sorted_wp[ind])
-        else:
-          eff_bin_data_val[bin_name].append(self.histograms_od["data"][wp].GetBinContent(bin_number))
-          eff_bin_wp[bin_name].append(self.sorted_wp[ind])
-
-    # Remove any 0 bins
-    for b in copy.deepcopy(bins):
-      bin_name = str(b[0]) + "to" + str(b[1])
-      if sum(eff_bin_data_val[bin_name]) == 0:
-        del eff_bin_data_val[bin_name]
-        del eff_bin_wp[bin_name]
-        bins.remove(b)
-
-    # rebin
-    for k, v in eff_bin_data_val.iteritems():
-      while not all(i >= rebin_threshold  for i in eff_bin_data_val[k]):
-        for b, val in enumerate(eff_bin_data_val[k][:-1]):
-          if val < rebin_threshold:
-            eff_bin_data_val[k][b] += eff_bin_data_val[k][b+1]
-            del eff_bin_data_val[k][b+1], eff_bin_wp[k][b+1]
-            break
-
-    # draw into histograms    
+    bin_names = [str(b[0]) + "to" + str(b[1]) for b in bins]
+    centers = np.array([(b[0]+b[1])/2 for b in bins])
+
+    # cumulative efficiencies and variances of each WP (rows) in each variable bin (columns)
+    cumulative = OrderedDict()
+    for tk in ["data","mc"]:
+      hists = [self.histograms_od[tk][wp] for wp in self.sorted_wp]
+      cumulative[tk] = (np.array([hist.contents[np.searchsorted(hist.edges,centers,side='right')] for hist in hists]),
+                        np.array([hist.variances[np.searchsorted(hist.edges,centers,side='right')] for hist in hists]))
+
+    # data efficiency of each WP bin, i.e. passing this WP, but not the next tighter one
+    eff_data = cumulative["data"][0].copy()
+    eff_data[:-1] -= eff_data[1:]
+
+    # thresholds per variable bin
+    if isinstance(rebin_threshold,dict):
+      thresholds = np.array([rebin_threshold[k] for k in bin_names],dtype=float)
+    else:
+      thresholds = np.broadcast_to(np.asarray(rebin_threshold,dtype=float),(len(bins),))
+
+    # rebin in a single pass over the WPs for all variable bins at once: a WP bin is merged
+    # into the WP bin before it as long as their combined efficiency is below the threshold
+    nwp = len(self.sorted_wp)
+    keep = np.zeros((nwp,len(bins)),dtype=bool) # first WP of each merged WP bin
+    total = np.zeros(len(bins)) # efficiency of current merged WP bin
+    first = np.zeros(len(bins),dtype=int) # first WP of current merged WP bin
+    for i in range(nwp):
+      start = (total >= thresholds) if i > 0 else np.ones(len(bins),dtype=bool)
+      keep[i,start] = True
+      first[start] = i
+      total = np.where(start,eff_data[i],total+eff_data[i])
+    # merge last WP bin into the one before if it is still below the threshold
+    below = (total < thresholds) & (keep.sum(axis=0) > 1)
+    keep[first[below],np.flatnonzero(below)] = False
+
+    # draw into histograms, skipping variable bins without any data efficiency
     temp_histograms_od = OrderedDict()
     for tk in ["data","mc"]:
       temp_histograms_od[tk] = OrderedDict()
-      for b in bins:
-        bin_name = str(b[0]) + "to" + str(b[1])
-        wp_bins = array('f', map(float,range(0,len(eff_bin_wp[bin_name])+1)))
-        wp_hist = ROOT.TH1D(bin_name,"",len(wp_bins)-1, wp_bins)
-        temp_histograms_od[tk][bin_name] = copy.deepcopy(wp_hist)
-        for ind, wp in enumerate(eff_bin_wp[bin_name]):
-          bin_number = self.histograms_od[tk][wp].FindBin((b[0]+b[1])/2)
-          if ind + 1 != len(eff_bin_wp[bin_name]):
-            temp_histograms_od[tk][bin_name].SetBinContent(ind+1, self.histograms_od[tk][wp].GetBinContent(bin_number) - self.histograms_od[tk][eff_bin_wp[bin_name][ind+1]].GetBinContent(bin_number))
-            temp_histograms_od[tk][bin_name].SetBinError(ind+1, (self.histograms_od[tk][wp].GetBinError(bin_number)**2 - self.histograms_od[tk][eff_bin_wp[bin_name][ind+1]].GetBinError(bin_number)**2)**0.5)
-          else:
-            temp_histograms_od[tk][bin_name].SetBinContent(ind+1, self.histograms_od[tk][wp].GetBinContent(bin_number))
-            temp_histograms_od[tk][bin_name].SetBinError(ind+1, self.histograms_od[tk][wp].GetBinError(bin_number))
-
-    self.histograms_od = copy.deepcopy(temp_histograms_od)
+    eff_bin_wp = OrderedDict()
+    for col, bin_name in enumerate(bin_names):
+      if eff_data[:,col].sum() == 0: continue
+      wps = np.flatnonzero(keep[:,col])
+      eff_bin_wp[bin_name] = [self.sorted_wp[wp] for wp in wps]
+      for tk, (contents, variances) in cumulative.items():
+        contents, variances = contents[wps,col], variances[wps,col]
+        contents[:-1] -= contents[1:]
+        variances[:-1] = np.maximum(variances[:-1]-variances[1:],0)
+        temp_histograms_od[tk][bin_name] = Hist1D(bin_name,range(0,len(wps)+1),
+                                                  np.concatenate([[0],contents,[0]]),np.concatenate([[0],variances,[0]]))
+
+    self.histograms_od = temp_histograms_od
     self.CalculateHistograms("sf")
-    self.rebinned_bins = copy.deepcopy(eff_bin_wp)
+    self.rebinned_bins = eff_bin_wp
 
   def ScaleWPHistogramsByHistogram(self,input_type,hist,divide=False):
     """
@@ -260,23 +398,47 @@ class ScoreSFTool:
         bins = []
         for k in self.rebinned_bins[bk]: bins.append(score_dict[k])
         bins.append(1.0)
-        score_bins = array('f', map(float,bins))
-        temp_histograms_od[tk][bk] = copy.deepcopy(ROOT.TH1D(bv.GetName(),"",len(score_bins)-1, score_bins))
-        for i in range(0,bv.GetNbinsX()+1):
-          temp_histograms_od[tk][bk].SetBinContent(i,bv.GetBinContent(i))
-          temp_histograms_od[tk][bk].SetBinError(i,bv.GetBinError(i))
+        score_bins = np.array(bins,dtype=np.float32) # same single-precision edges as before
+        contents, variances = bv.contents.copy(), bv.variances.copy()
+        contents[-1] = variances[-1] = 0 # overflow is not copied
+        temp_histograms_od[tk][bk] = Hist1D(bv.GetName(),score_bins,contents,variances)
 
-    self.histograms_od = copy.deepcopy(temp_histograms_od)
+    self.histograms_od = temp_histograms_od
         
   def FitSpline(self,input_type):
     """
-    Fit splines to an input type of histograms.
+    Fit splines to an input type of histograms, through the bin centers as ROOT.TSpline3,
+    but as NumPy CubicSpline, which can be evaluated for arrays without ROOT.
 
     :param input_type: Type of histograms to fit spline for
     """
     self.spline_od[input_type] = OrderedDict()
-    for tk, tv in self.histograms_od["sf"].iteritems():
-      self.spline_od[input_type][tk] = ROOT.TSpline3(tv)
+    for tk, tv in self.histograms_od[input_type].iteritems():
+      self.spline_od[input_type][tk] = CubicSpline.fromHistogram(tv.edges,tv.contents[1:-1])
+
+  def GetSplineTable(self,input_type="sf"):
+    """
+    Return splines from FitSpline as a ScoreSplineTable for smooth vectorized evaluation
+    in bins of the variable, with one batched call per variable bin.
+
+    :param input_type: Type of histograms the splines were fitted for
+    :return: ScoreSplineTable
+    """
+    var_low, var_high = [], []
+    last_key = list(self.spline_od[input_type].keys())[-1]
+    for k in self.spline_od[input_type].keys():
+      var_low.append(float(k.split("to")[0]))
+      var_high.append(float(k.split("to")[1]) if k != last_key else float("inf"))
+    return ScoreSplineTable(var_low,var_high,self.spline_od[input_type].values())
+
+  def DumpSplineTable(self,filename,input_type="sf"):
+    """
+    Write spline table (see GetSplineTable) to a .npz file.
+
+    :param filename: Name of output .npz file
+    :param input_type: Type of histograms the splines were fitted for
+    """
+    self.GetSplineTable(input_type).write(filename)
 
   def PlotEfficienciesAndSFs(self,logx=True,title_left="",title_right="",x_label="",ratio_range=[0.8,1.2],extra_ratio_line=[0.9,1.1],replace=[],replace_labels=[],individual=None,folder="."):
     """
@@ -338,11 +500,13 @@ class ScoreSFTool:
                    fit=spline
                    )
 
-  def DumpSFTF2(self,variation="cent"):
+  def GetSFFormula(self,variation="cent"):
     """
-    Return SF in ROOT.TF2 form from class
-    
+    Return formula of the SF in ROOT.TF2 form (see DumpSFTF2) as string, without ROOT,
+    e.g. to create the TF2 in another process.
+
     :param variation: Return cent, up or down uncertainty variation.
+    :return: Formula with x the variable and y the score
     """
     func_str = "("
     for k,v in self.histograms_od["sf"].iteritems():
@@ -367,11 +531,55 @@ class ScoreSFTool:
           func_str += "({}*(y>={})))) + ".format(max(0,v.GetBinContent(ind_wp+1)+shift),v.GetBinLowEdge(ind_wp+1))
 
     func_str = func_str[:-3]+")"
+    return func_str
+
+  def DumpSFTF2(self,variation="cent",name=None):
+    """
+    Return SF in ROOT.TF2 form from class
     
-    tf2 = ROOT.TF2(variation,func_str,0.0,1000.0,0.0,1.0)
-    return tf2
+    :param variation: Return cent, up or down uncertainty variation.
+    :param name: Name of TF2, default: the variation
+    """
+    return self.SFFormulaToTF2(name or variation,self.GetSFFormula(variation))
+
+  @staticmethod
+  def SFFormulaToTF2(name,formula):
+    """
+    Create ROOT.TF2 from a SF formula of GetSFFormula.
+
+    :param name: Name of TF2
+    :param formula: Formula with x the variable and y the score
+    """
+    return ROOT.TF2(name,formula,0.0,1000.0,0.0,1.0)
 
-  def DrawHistogramsWithRatio(self, hists, titles,x_label="",y_label="",y_ratio_label="",colours=[2,6,42,46,39,49], title_left="", title_right="",ratio_range=[0.8,1.2], extra_ratio_line=[0.9,1.1], save_name="plot", anchor_to_zero=True, logx=True, logy=False,replace=[],replace_labels=[],do_split_ratio_uncert=False,ratio=True,fit=None):
+  def GetSFTable(self):
+    """
+    Return SF as a ScoreTable for fast vectorized evaluation in bins of the variable and score,
+    equivalent to the TF2s from DumpSFTF2, with the down, cent and up variations together.
+
+    :return: ScoreTable
+    """
+    var_low, var_high, rows, score_edges, values = [], [], [], [], []
+    last_key = self.histograms_od["sf"].keys()[-1]
+    for row, (k,v) in enumerate(self.histograms_od["sf"].iteritems()):
+      var_low.append(float(k.split("to")[0]))
+      var_high.append(float(k.split("to")[1]) if k != last_key else float("inf"))
+      for ind_wp, wp in enumerate(self.rebinned_bins[k]):
+        content, error = v.GetBinContent(ind_wp+1), v.GetBinError(ind_wp+1)
+        rows.append(row)
+        score_edges.append(v.GetBinLowEdge(ind_wp+1))
+        values.append([max(0,content-error),max(0,content),max(0,content+error)])
+    return ScoreTable(var_low,var_high,rows,score_edges,values)
+
+  def DumpSFTable(self,filename):
+    """
+    Write SF table (see GetSFTable) to a .npz file, as compact alternative to the TF2s.
+
+    :param filename: Name of output .npz file
+    """
+    self.GetSFTable().write(filename)
+
+  def DrawHistogramsWithRatio(self, hists, titles,x_label="",y_label="",y_ratio_label="",colours=[2,6,42,46,39,49], title_left="", title_right="",ratio_range=[0.8,1.2], extra_ratio_line=[0.9,1.1], save_name="plot", anchor_to_zero=True, logx=True, logy=False,replace=[],replace_labels=[],do_split_ratio_uncert=False,ratio=True,fit=None,pdf=None):
     """ 
     Plotting function to draw multipe histograms and their ratios if needed.
 
@@ -395,7 +603,18 @@ class ScoreSFTool:
     :param do_split_ratio_uncert: Changes how the rato uncertainty is drawn
     :param ratio: Add ratio to plot.
     :param fit: Draw fit on plot.
+    :param pdf: Print to this (multi-page) PDF instead of save_name.pdf, e.g. "plots.pdf(" to open it
     """ 
+    if self.plot_mode == "none": return
+    if self.plot_mode == "defer":
+      # keep snapshot of the histograms, which may still change
+      hists = [h.Clone() if isinstance(h,Hist1D) else h for h in hists]
+      self.plot_requests.append((hists,titles,dict(x_label=x_label,y_label=y_label,y_ratio_label=y_ratio_label,colours=colours,
+                                 title_left=title_left,title_right=title_right,ratio_range=ratio_range,extra_ratio_line=extra_ratio_line,
+                                 save_name=save_name,anchor_to_zero=anchor_to_zero,logx=logx,logy=logy,replace=replace,
+                                 replace_labels=replace_labels,do_split_ratio_uncert=do_split_ratio_uncert,ratio=ratio,fit=fit)))
+      return
+    hists = [h.ToTH1() if isinstance(h,Hist1D) else h for h in hists]
     c = ROOT.TCanvas('c','c',600,600)
 
     if ratio:
@@ -448,8 +667,14 @@ class ScoreSFTool:
       hists[ind+1].SetMarkerStyle(2)
 
     if fit != None: 
-      fit.SetLineColor(2)
-      fit.Draw("same")
+      if isinstance(fit,CubicSpline): # draw as curve between the knots
+        x = np.linspace(fit.x[0],fit.x[-1],200)
+        fit = ROOT.TGraph(len(x),array('d',x.tolist()),array('d',fit(x).tolist()))
+        fit.SetLineColor(2)
+        fit.Draw("L same")
+      else:
+        fit.SetLineColor(2)
+        fit.Draw("same")
 
     minimum = 999999.0
     maximum = 0.0
@@ -544,9 +769,39 @@ class ScoreSFTool:
       self.DrawTitle(c, title_right, 3, scale=.7)
 
     c.Update()
-    c.SaveAs(save_name+".pdf")
+    if pdf:
+      c.Print(pdf,"Title:"+os.path.basename(save_name))
+    else:
+      c.SaveAs(save_name+".pdf")
     c.Close()
 
+  def RenderPlots(self,nprocs=1,pdf=None):
+    """
+    Draw the plots recorded in "defer" plot mode, and clear them.
+
+    :param nprocs: Number of processes to draw separate PDFs in parallel
+    :param pdf: Draw all plots as pages of this single PDF instead of separate PDFs
+    """
+    requests, self.plot_requests = self.plot_requests, list()
+    if not requests: return
+    if pdf:
+      for ind, request in enumerate(requests):
+        page = pdf + ("(" if ind == 0 and len(requests) > 1 else ")" if ind+1 == len(requests) and len(requests) > 1 else "")
+        DrawPlotRequests([request],pdf=page)
+    elif nprocs > 1:
+      chunks = [requests[i::nprocs] for i in range(nprocs)]
+      pool = Pool(nprocs)
+      try:
+        pool.map(DrawPlotRequests,[c for c in chunks if c])
+        pool.close()
+      except:
+        pool.terminate()
+        raise
+      finally:
+        pool.join()
+    else:
+      DrawPlotRequests(requests)
+
   def DrawTitle(self, pad, text, align, scale=1):
     """
     Draw title on a ROOT canvas
@@ -637,3 +892,14 @@ class ScoreSFTool:
         latex.DrawLatex(l+x_shift, b-offset, str(replace[ind]))
       else:
         latex.DrawLatex(l+x_shift, b-offset, str(num))
+
+def DrawPlotRequests(requests,pdf=None):
+  """
+  Draw list of plots recorded by ScoreSFTool in "defer" plot mode, e.g. in another process.
+
+  :param requests: List of plot requests
+  :param pdf: Print to this (multi-page) PDF instead of separate PDFs
+  """
+  ssf = ScoreSFTool()
+  for hists, titles, kwargs in requests:
+    ssf.DrawHistogramsWithRatio(hists,titles,pdf=pdf,**kwargs)
@@ -3,28 +3,34 @@
 from __future__ import print_function
 import os
 from math import sqrt
+import numpy as np
 if 'CMSSW_BASE' in os.environ: # assume CMSSW environment
-  from TauPOG.TauIDSFs.helpers import ensureTFile, extractTH1
+  from TauPOG.TauIDSFs.sftables import loadTables, listTables, readObjects, DMTable, StackedTable, toVariations, scalevariations, eventProduct
   datapath = os.path.join(os.environ.get('CMSSW_BASE',""),"src/TauPOG/TauIDSFs/data")
 else:
-  from helpers import ensureTFile, extractTH1
+  from sftables import loadTables, listTables, readObjects, DMTable, StackedTable, toVariations, scalevariations, eventProduct
   datapath = os.path.join(os.environ.get('TAUIDSFs',""),"data")
 campaigns  = [
   '2016Legacy','2017ReReco','2018ReReco',
   'UL2016_preVFP', 'UL2016_postVFP', 'UL2017', 'UL2018',
 ]
+workingpoints = [
+  'VVVLoose','VVLoose','VLoose','Loose','Medium','Tight','VTight','VVTight',
+]
 
 
 class TauIDSFTool:
     
     def __init__(self, year, id, wp='Tight', dm=False, emb=False,
-                 otherVSlepWP=False, path=datapath, verbose=False):
+                 otherVSlepWP=False, path=datapath, verbose=False, cache=None):
         """Choose the IDs and WPs for SFs. For available tau IDs and WPs, check
         https://cms-nanoaod-integration.web.cern.ch/integration/master-102X/mc102X_doc.html#Tau
         Options:
           dm:           use decay mode-dependent SFs
           emb:          use SFs for embedded samples
           otherVSlepWP: extra uncertainty if you are using a different DeepTauVSe/mu WP than used in the measurement
+          cache:        read SFs from a ROOT-free cache (SFCache, path to .npz or flat binary file, or 'shm:<name>'
+                        of a cache published into shared memory) instead of the ROOT files
         """
         assert year in campaigns, "You must choose a year from %s! Got %r."%(', '.join(campaigns),year)
         self.ID       = id
@@ -32,72 +38,100 @@ class TauIDSFTool:
         self.verbose  = verbose
         self.extraUnc = None
         self.filename = None
+        self.table    = None # ROOT-free table of DM- or eta-dependent SFs
+        self.funcs    = None # ROOT-free (compiled) functions of pT-dependent SFs
+        self._hist    = None # original ROOT objects, only read on demand
+        self._func    = None
         
+        fname = self.getFilename(year,id,dm=dm,emb=emb,path=path)
         if id in ['MVAoldDM2017v2','DeepTau2017v2p1VSjet']:
           if dm: # DM-dependent SFs
-            if emb:
-              if 'oldDM' in id:
-                raise IOError("Scale factors for embedded samples not available for ID '%s'!"%id)
-              fname = os.path.join(path,"TauID_SF_dm_%s_%s_EMB.root"%(id,year))
-            else:
-              fname = os.path.join(path,"TauID_SF_dm_%s_%s.root"%(id,year))
-            file = ensureTFile(fname,verbose=verbose)
-            self.hist = extractTH1(file,wp)
-            self.hist.SetDirectory(0)
-            file.Close()
+            self.table,     = loadTables(fname,[wp],cache=cache,verbose=verbose)
             self.filename   = fname
             self.DMs        = [0,1,10] if 'oldDM' in id else [0,1,10,11]
             self.getSFvsPT  = self.disabled
             self.getSFvsEta = self.disabled
+            self.getSFvsPTArray = self.disabled
+            self.getSFvsEtaArray = self.disabled
             if otherVSlepWP:
               if emb:
                 self.extraUnc = 0.05
               else:
                 self.extraUnc = 0.03
+            self.getSFArray = self.getSFvsDMArray
+            self.dmTable = DMTable.fromTH1Table(self.table,self.DMs)
+            if self.extraUnc:
+              self.dmTable.errors = np.sqrt( self.dmTable.errors**2 + (self.dmTable.values*self.extraUnc)**2 )
           else: # pT-dependent SFs
-            if emb:
-              if 'oldDM' in id:
-                raise IOError("Scale factors for embedded samples not available for ID '%s'!"%id)
-              fname = os.path.join(path,"TauID_SF_pt_%s_%s_EMB.root"%(id,year))
-            else:
-              fname = os.path.join(path,"TauID_SF_pt_%s_%s.root"%(id,year))
-            file = ensureTFile(fname,verbose=verbose)
-            self.func         = { }
-            self.func[None]   = file.Get("%s_cent"%(wp))
-            self.func['Up']   = file.Get("%s_up"%(wp))
-            self.func['Down'] = file.Get("%s_down"%(wp))
-            file.Close()
+            funcs = loadTables(fname,["%s_cent"%(wp),"%s_up"%(wp),"%s_down"%(wp)],cache=cache,verbose=verbose)
+            self.funcs         = { } # compiled TF1s
+            self.funcs[None]   = funcs[0]
+            self.funcs['Up']   = funcs[1]
+            self.funcs['Down'] = funcs[2]
             self.filename   = fname
             self.getSFvsDM  = self.disabled
             self.getSFvsEta = self.disabled
+            self.getSFvsDMArray = self.disabled
+            self.getSFvsEtaArray = self.disabled
+            self.getSFArray = self.getSFvsPTArray
             if otherVSlepWP:
-              if emb:
-                self.extraUnc = lambda pt: (0.05 if pt<100 else 0.15)
-              else:
-                self.extraUnc = lambda pt: (0.03 if pt<100 else 0.15)
-        elif id in ['antiMu3','antiEleMVA6','DeepTau2017v2p1VSmu','DeepTau2017v2p1VSe']:
-            if emb:
-              raise IOError("Scale factors for embedded samples not available for ID '%s'!"%id)
-            fname = os.path.join(path,"TauID_SF_eta_%s_%s.root"%(id,year))
-            file = ensureTFile(fname,verbose=verbose)
-            self.hist = extractTH1(file,wp)
-            self.hist.SetDirectory(0)
-            file.Close()
+              extraUncLow, extraUncHigh = (0.05,0.15) if emb else (0.03,0.15)
+              self.extraUnc      = lambda pt: (extraUncLow if pt<100 else extraUncHigh)
+              self.extraUncArray = lambda pt: np.where(pt<100,extraUncLow,extraUncHigh)
+        else: # eta-dependent SFs
+            self.table,     = loadTables(fname,[wp],cache=cache,verbose=verbose)
             self.filename   = fname
             self.genmatches = [1,3] if any(s in id.lower() for s in ['ele','vse']) else [2,4]
             self.getSFvsPT  = self.disabled
             self.getSFvsDM  = self.disabled
-        else:
-          raise IOError("Did not recognize tau ID '%s'!"%id)
+            self.getSFvsPTArray = self.disabled
+            self.getSFvsDMArray = self.disabled
+            self.getSFArray = self.getSFvsEtaArray
+    
+    @property
+    def hist(self):
+        """Original ROOT histogram of DM- or eta-dependent SFs, read from the ROOT file on first use.
+        The tool itself only uses the ROOT-free self.table."""
+        if self.table is None:
+          raise AttributeError("No histogram for pT-dependent SFs!")
+        if self._hist is None:
+          self._hist, = readObjects(self.filename,[self.WP],verbose=self.verbose)
+        return self._hist
+    
+    @property
+    def func(self):
+        """Original ROOT TF1s of pT-dependent SFs for None, 'Up' and 'Down', read from the ROOT file on first use.
+        The tool itself only uses the ROOT-free self.funcs."""
+        if self.funcs is None:
+          raise AttributeError("No functions for DM- or eta-dependent SFs!")
+        if self._func is None:
+          names = ["%s_cent"%(self.WP),"%s_up"%(self.WP),"%s_down"%(self.WP)]
+          self._func = dict(zip([None,'Up','Down'],readObjects(self.filename,names,verbose=self.verbose)))
+        return self._func
+    
+    @staticmethod
+    def getFilename(year, id, dm=False, emb=False, path=datapath):
+        """Return path to the file with the SFs of a given tau ID."""
+        if id in ['MVAoldDM2017v2','DeepTau2017v2p1VSjet']:
+          if emb and 'oldDM' in id:
+            raise IOError("Scale factors for embedded samples not available for ID '%s'!"%id)
+          return os.path.join(path,"TauID_SF_%s_%s_%s%s.root"%('dm' if dm else 'pt',id,year,'_EMB' if emb else ''))
+        elif id in ['antiMu3','antiEleMVA6','DeepTau2017v2p1VSmu','DeepTau2017v2p1VSe']:
+          if emb:
+            raise IOError("Scale factors for embedded samples not available for ID '%s'!"%id)
+          return os.path.join(path,"TauID_SF_eta_%s_%s.root"%(id,year))
+        raise IOError("Did not recognize tau ID '%s'!"%id)
     
     def getSFvsPT(self, pt, genmatch=5, unc=None):
-        """Get tau ID SF vs. tau pT."""
+        """Get tau ID SF vs. tau pT. Also accepts NumPy arrays of pt and genmatch."""
+        if isinstance(pt,np.ndarray) or isinstance(genmatch,np.ndarray):
+          return self.getSFvsPTArray(pt,genmatch,unc)
         if genmatch==5:
           if self.extraUnc:
-            sf       = self.func[None].Eval(pt)
+            sf       = self.funcs[None].Eval(pt)
             extraUnc = self.extraUnc(pt)
-            errDown  = sqrt( (sf-self.func['Down'].Eval(pt))**2 + (sf*extraUnc)**2 )
-            errUp    = sqrt( (sf-self.func['Up'  ].Eval(pt))**2 + (sf*extraUnc)**2 )
+            errDown  = sqrt( (sf-self.funcs['Down'].Eval(pt))**2 + (sf*extraUnc)**2 )
+            errUp    = sqrt( (sf-self.funcs['Up'  ].Eval(pt))**2 + (sf*extraUnc)**2 )
             if unc=='All':
               return sf-errDown, sf, sf+errUp
             elif unc=='Up':
@@ -107,18 +141,38 @@ class TauIDSFTool:
               return sfDown
           else:
             if unc=='All':
-              return self.func['Down'].Eval(pt), self.func[None].Eval(pt), self.func['Up'].Eval(pt)
-          return self.func[unc].Eval(pt)
+              return self.funcs['Down'].Eval(pt), self.funcs[None].Eval(pt), self.funcs['Up'].Eval(pt)
+          return self.funcs[unc].Eval(pt)
         elif unc=='All':
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getSFvsPTArray(self, pt, genmatch=5, unc=None):
+        """Get tau ID SF vs. tau pT for NumPy arrays of pt and genmatch."""
+        pt, genmatch = np.broadcast_arrays(np.asarray(pt,dtype=np.float64),genmatch)
+        real = (genmatch==5)
+        if self.extraUnc and unc!=None:
+          sf       = self.funcs[None](pt)
+          extraUnc = self.extraUncArray(pt)
+          errDown  = np.sqrt( (sf-self.funcs['Down'](pt))**2 + (sf*extraUnc)**2 )
+          errUp    = np.sqrt( (sf-self.funcs['Up'  ](pt))**2 + (sf*extraUnc)**2 )
+          if unc=='All':
+            return np.where(real,sf-errDown,1.0), np.where(real,sf,1.0), np.where(real,sf+errUp,1.0)
+          elif unc=='Up':
+            sf = sf+errUp
+          elif unc=='Down':
+            sf = np.where(errDown<sf,sf-errDown,0.0) # prevent negative SF
+          return np.where(real,sf,1.0)
+        elif unc=='All':
+          return tuple(np.where(real,self.funcs[u](pt),1.0) for u in ['Down',None,'Up'])
+        return np.where(real,self.funcs[unc](pt),1.0)
+    
     def getSFvsDM(self, pt, dm, genmatch=5, unc=None):
-        """Get tau ID SF vs. tau DM."""
+        """Get tau ID SF vs. tau DM. Also accepts NumPy arrays of pt, dm and genmatch."""
+        if isinstance(dm,np.ndarray) or isinstance(pt,np.ndarray) or isinstance(genmatch,np.ndarray):
+          return self.getSFvsDMArray(pt,dm,genmatch,unc)
         if genmatch==5 and dm in self.DMs and pt>40:
-          bin = self.hist.GetXaxis().FindBin(dm)
-          sf  = self.hist.GetBinContent(bin)
-          err = self.hist.GetBinError(bin)
+          sf, err = self.table.lookup(dm)
           if self.extraUnc:
             err = sqrt( err**2 + (sf*self.extraUnc)**2 )
           if unc=='Up':
@@ -133,13 +187,30 @@ class TauIDSFTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getSFvsDMArray(self, pt, dm, genmatch=5, unc=None):
+        """Get tau ID SF vs. tau DM for NumPy arrays of pt, dm and genmatch."""
+        pt, dm, genmatch = np.broadcast_arrays(pt,dm,genmatch)
+        bin, valid = self.dmTable.index(dm)
+        real = valid & (genmatch==5) & (pt>40)
+        sf   = self.dmTable.values[bin]
+        if unc in ['Up','Down','All']:
+          err = self.dmTable.errors[bin] # includes extra uncertainty
+          if unc=='Up':
+            sf = sf+err
+          elif unc=='Down':
+            sf = np.where(err<sf,sf-err,0.0) # prevent negative SF
+          else:
+            sfDown = np.where(err<sf,sf-err,0.0) # prevent negative SF
+            return np.where(real,sfDown,1.0), np.where(real,sf,1.0), np.where(real,sf+err,1.0)
+        return np.where(real,sf,1.0)
+    
     def getSFvsEta(self, eta, genmatch, unc=None):
-        """Get tau ID SF vs. tau eta."""
+        """Get tau ID SF vs. tau eta. Also accepts NumPy arrays of eta and genmatch."""
+        if isinstance(eta,np.ndarray) or isinstance(genmatch,np.ndarray):
+          return self.getSFvsEtaArray(eta,genmatch,unc)
         eta = abs(eta)
         if genmatch in self.genmatches:
-          bin = self.hist.GetXaxis().FindBin(eta)
-          sf  = self.hist.GetBinContent(bin)
-          err = self.hist.GetBinError(bin)
+          sf, err = self.table.lookup(eta)
           if self.extraUnc:
             err = sqrt( err**2 + (sf*self.extraUnc)**2 )
           if unc=='Up':
@@ -154,13 +225,151 @@ class TauIDSFTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getSFvsEtaArray(self, eta, genmatch, unc=None):
+        """Get tau ID SF vs. tau eta for NumPy arrays of eta and genmatch."""
+        eta, genmatch = np.broadcast_arrays(np.abs(eta),genmatch)
+        bin  = self.table.findBin(eta)
+        real = np.isin(genmatch,self.genmatches)
+        sf   = self.table.values[bin]
+        if unc in ['Up','Down','All']:
+          err = self.table.errors[bin]
+          if self.extraUnc:
+            err = np.sqrt( err**2 + (sf*self.extraUnc)**2 )
+          if unc=='Up':
+            sf = sf+err
+          elif unc=='Down':
+            sf = np.where(err<sf,sf-err,0.0) # prevent negative SF
+          else:
+            sfDown = np.where(err<sf,sf-err,0.0) # prevent negative SF
+            return np.where(real,sfDown,1.0), np.where(real,sf,1.0), np.where(real,sf+err,1.0)
+        return np.where(real,sf,1.0)
+    
+    def getVariations(self, *args, **kwargs):
+        """Get down, nominal and up tau ID SFs in one structured array with fields 'down', 'nom' and 'up'.
+        Takes the same array arguments (without unc) as getSFvsPT, getSFvsDM or getSFvsEta, depending on the tool."""
+        return toVariations(*self.getSFArray(*args,unc='All',**kwargs))
+    
+    def getEventSFs(self, offsets, *args, **kwargs):
+        """Get down, nominal and up tau ID SFs for flat arrays of taus, and their product per event.
+        The events are given by offsets of length nevents+1 into the flat arrays, e.g. toOffsets(nTau).
+        Takes the same array arguments as getVariations, and returns two structured arrays:
+        the SFs per tau, and the event weights."""
+        sfs = self.getVariations(*args,**kwargs)
+        return sfs, eventProduct(sfs,offsets)
+    
+    @staticmethod
+    def disabled(*args,**kwargs):
+        raise AttributeError("Disabled method.")
+    
+
+class TauIDSFMultiWPTool:
+    
+    def __init__(self, year, id, wps=None, dm=False, emb=False,
+                 otherVSlepWP=False, path=datapath, verbose=False, cache=None):
+        """Load the SFs of several WPs at once, to evaluate them together into arrays of shape (n_taus, n_WPs).
+        By default, use all WPs available in the file, ordered from loose to tight.
+        The other options are the same as for TauIDSFTool."""
+        fname = TauIDSFTool.getFilename(year,id,dm=dm,emb=emb,path=path)
+        vspt  = id in ['MVAoldDM2017v2','DeepTau2017v2p1VSjet'] and not dm
+        if wps is None:
+          names = listTables(fname,cache=cache,verbose=verbose)
+          wps   = [wp for wp in workingpoints if (wp+'_cent' if vspt else wp) in names]
+        names = [n%(wp) for wp in wps for n in (['%s_cent','%s_up','%s_down'] if vspt else ['%s'])]
+        loadTables(fname,names,cache=cache,verbose=verbose) # read all WPs in one go
+        self.ID       = id
+        self.WPs      = list(wps)
+        self.filename = fname
+        self.tools    = [TauIDSFTool(year,id,wp,dm=dm,emb=emb,otherVSlepWP=otherVSlepWP,
+                                     path=path,verbose=verbose,cache=cache) for wp in wps]
+        tool          = self.tools[0]
+        self.extraUnc = tool.extraUnc
+        if vspt:
+          self.extraUncArray = getattr(tool,'extraUncArray',None)
+          self.funcs = { u: StackedTable.fromFunctions([t.funcs[u] for t in self.tools]) for u in [None,'Up','Down'] }
+          self.getSFvsDM  = self.disabled
+          self.getSFvsEta = self.disabled
+          self.getSFArray = self.getSFvsPT
+        elif dm:
+          self.DMs    = tool.DMs
+          self.dmTable = DMTable(self.DMs,np.stack([t.dmTable.values for t in self.tools],axis=-1),
+                                          np.stack([t.dmTable.errors for t in self.tools],axis=-1))
+          self.getSFvsPT  = self.disabled
+          self.getSFvsEta = self.disabled
+          self.getSFArray = self.getSFvsDM
+        else:
+          self.genmatches = tool.genmatches
+          self.table = StackedTable.fromTH1Tables([t.table for t in self.tools])
+          self.getSFvsPT  = self.disabled
+          self.getSFvsDM  = self.disabled
+          self.getSFArray = self.getSFvsEta
+    
+    def getSFvsPT(self, pt, genmatch=5, unc=None):
+        """Get tau ID SFs of all WPs vs. tau pT for NumPy arrays of pt and genmatch."""
+        pt, genmatch = np.broadcast_arrays(np.asarray(pt,dtype=np.float64),genmatch)
+        real = (genmatch==5)[...,None]
+        if self.extraUnc and unc!=None:
+          sf       = self.funcs[None](pt)
+          extraUnc = self.extraUncArray(pt)[...,None]
+          errDown  = np.sqrt( (sf-self.funcs['Down'](pt))**2 + (sf*extraUnc)**2 )
+          errUp    = np.sqrt( (sf-self.funcs['Up'  ](pt))**2 + (sf*extraUnc)**2 )
+          if unc=='All':
+            return np.where(real,sf-errDown,1.0), np.where(real,sf,1.0), np.where(real,sf+errUp,1.0)
+          elif unc=='Up':
+            sf = sf+errUp
+          elif unc=='Down':
+            sf = np.where(errDown<sf,sf-errDown,0.0) # prevent negative SF
+          return np.where(real,sf,1.0)
+        elif unc=='All':
+          return tuple(np.where(real,self.funcs[u](pt),1.0) for u in ['Down',None,'Up'])
+        return np.where(real,self.funcs[unc](pt),1.0)
+    
+    def getSFvsDM(self, pt, dm, genmatch=5, unc=None):
+        """Get tau ID SFs of all WPs vs. tau DM for NumPy arrays of pt, dm and genmatch."""
+        pt, dm, genmatch = np.broadcast_arrays(pt,dm,genmatch)
+        bin, valid = self.dmTable.index(dm)
+        real = (valid & (genmatch==5) & (pt>40))[...,None]
+        sf   = self.dmTable.values[bin]
+        if unc in ['Up','Down','All']:
+          err = self.dmTable.errors[bin] # includes extra uncertainty
+          if unc=='Up':
+            sf = sf+err
+          elif unc=='Down':
+            sf = np.where(err<sf,sf-err,0.0) # prevent negative SF
+          else:
+            sfDown = np.where(err<sf,sf-err,0.0) # prevent negative SF
+            return np.where(real,sfDown,1.0), np.where(real,sf,1.0), np.where(real,sf+err,1.0)
+        return np.where(real,sf,1.0)
+    
+    def getSFvsEta(self, eta, genmatch, unc=None):
+        """Get tau ID SFs of all WPs vs. tau eta for NumPy arrays of eta and genmatch."""
+        eta, genmatch = np.broadcast_arrays(np.abs(eta),genmatch)
+        bin  = self.table.findBin(eta)
+        real = np.isin(genmatch,self.genmatches)[...,None]
+        sf   = self.table.columns['values'][bin]
+        if unc in ['Up','Down','All']:
+          err = self.table.columns['errors'][bin]
+          if self.extraUnc:
+            err = np.sqrt( err**2 + (sf*self.extraUnc)**2 )
+          if unc=='Up':
+            sf = sf+err
+          elif unc=='Down':
+            sf = np.where(err<sf,sf-err,0.0) # prevent negative SF
+          else:
+            sfDown = np.where(err<sf,sf-err,0.0) # prevent negative SF
+            return np.where(real,sfDown,1.0), np.where(real,sf,1.0), np.where(real,sf+err,1.0)
+        return np.where(real,sf,1.0)
+    
+    def getVariations(self, *args, **kwargs):
+        """Get down, nominal and up tau ID SFs of all WPs in one structured array of shape (n_taus, n_WPs)."""
+        return toVariations(*self.getSFArray(*args,unc='All',**kwargs))
+    
     @staticmethod
     def disabled(*args,**kwargs):
         raise AttributeError("Disabled method.")
     
 
 class TauESTool:
-    def __init__(self, year, id='DeepTau2017v2p1VSjet', path=datapath, verbose=False):
+    def __init__(self, year, id='DeepTau2017v2p1VSjet', path=datapath, verbose=False, cache=None):
         """Choose the IDs and WPs for SFs."""
         if "UL" in year:
           print(">>> TauESTool: Warning! Using pre-UL (%r) TESs at high pT (for uncertainties only)..."%(year))
@@ -171,36 +380,47 @@ class TauESTool:
         assert year_highpt in campaigns, "You must choose a year from %s! Got %r."%(', '.join(campaigns),year_highpt)
         fname_lowpt  = os.path.join(path,"TauES_dm_%s_%s.root"%(id,year))
         fname_highpt = os.path.join(path,"TauES_dm_%s_%s_ptgt100.root"%(id,year_highpt))
-        file_lowpt   = ensureTFile(fname_lowpt, verbose=verbose)
-        file_highpt  = ensureTFile(fname_highpt,verbose=verbose)
-        self.hist_lowpt  = extractTH1(file_lowpt, 'tes')
-        self.hist_highpt = extractTH1(file_highpt,'tes')
-        self.hist_lowpt.SetDirectory(0)
-        self.hist_highpt.SetDirectory(0)
-        file_lowpt.Close()
-        file_highpt.Close()
+        self.table_lowpt,  = loadTables(fname_lowpt, ['tes'],cache=cache,verbose=verbose)
+        self.table_highpt, = loadTables(fname_highpt,['tes'],cache=cache,verbose=verbose)
+        self.verbose = verbose
+        self._hist_lowpt  = None # original ROOT histograms, only read on demand
+        self._hist_highpt = None
         self.pt_low  = 34  # average pT in Z -> tautau measurement (incl. in DM)
         self.pt_high = 170 # average pT in W* -> taunu measurement (incl. in DM)
         self.DMs     = [0,1,10] if "oldDM" in id else [0,1,10,11]
+        self.tesTable        = DMTable.fromTH1Table(self.table_lowpt, self.DMs)
+        self.tesTable_highpt = DMTable.fromTH1Table(self.table_highpt,self.DMs)
         self.filename = fname_lowpt
         self.filename_highpt = fname_highpt
     
+    @property
+    def hist_lowpt(self):
+        """Original ROOT histogram of the TES, read from the ROOT file on first use."""
+        if self._hist_lowpt is None:
+          self._hist_lowpt, = readObjects(self.filename,['tes'],verbose=self.verbose)
+        return self._hist_lowpt
+    
+    @property
+    def hist_highpt(self):
+        """Original ROOT histogram of the TES at high pT, read from the ROOT file on first use."""
+        if self._hist_highpt is None:
+          self._hist_highpt, = readObjects(self.filename_highpt,['tes'],verbose=self.verbose)
+        return self._hist_highpt
+    
     def getTES(self, pt, dm, genmatch=5, unc=None):
-        """Get tau ES vs. tau DM."""
+        """Get tau ES vs. tau DM. Also accepts NumPy arrays of pt, dm and genmatch."""
+        if isinstance(dm,np.ndarray) or isinstance(pt,np.ndarray) or isinstance(genmatch,np.ndarray):
+          return self.getTESArray(pt,dm,genmatch,unc)
         if genmatch==5 and dm in self.DMs:
-          bin = self.hist_lowpt.GetXaxis().FindBin(dm)
-          tes = self.hist_lowpt.GetBinContent(bin)
+          tes, err_low = self.table_lowpt.lookup(dm)
           if unc!=None:
             if pt>=self.pt_high: # high pT
-              bin_high = self.hist_highpt.GetXaxis().FindBin(dm)
-              err      = self.hist_highpt.GetBinError(bin_high)
+              err      = self.table_highpt.lookup(dm)[1]
             elif pt>self.pt_low: # linearly interpolate between low and high pT
-              bin_high = self.hist_highpt.GetXaxis().FindBin(dm)
-              err_high = self.hist_highpt.GetBinError(bin_high)
-              err_low  = self.hist_lowpt.GetBinError(bin)
+              err_high = self.table_highpt.lookup(dm)[1]
               err      = err_low + (err_high-err_low)/(self.pt_high-self.pt_low)*(pt-self.pt_low)
             else: # low pT
-              err      = self.hist_lowpt.GetBinError(bin)
+              err      = err_low
             if unc=='Up':
               tes += err
             elif unc=='Down':
@@ -213,12 +433,37 @@ class TauESTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getTESArray(self, pt, dm, genmatch=5, unc=None):
+        """Get tau ES vs. tau DM for NumPy arrays of pt, dm and genmatch."""
+        pt, dm, genmatch = np.broadcast_arrays(np.asarray(pt,dtype=np.float64),dm,genmatch)
+        bin, valid = self.tesTable.index(dm)
+        real = valid & (genmatch==5)
+        tes  = self.tesTable.values[bin]
+        if unc!=None:
+          errLow  = self.tesTable.errors[bin]
+          errHigh = self.tesTable_highpt.errors[bin]
+          ptClip  = np.maximum(pt,self.pt_low) # low pT: no interpolation
+          err     = errLow + (errHigh-errLow)/(self.pt_high-self.pt_low)*(ptClip-self.pt_low) # linearly interpolate
+          err     = np.where(pt>=self.pt_high,errHigh,err) # high pT
+          if unc=='Up':
+            tes = tes+err
+          elif unc=='Down':
+            tes = np.where(err<tes,tes-err,0.0) # prevent negative TES
+          elif unc=='All':
+            tesDown = np.where(err<tes,tes-err,0.0) # prevent negative TES
+            return np.where(real,tesDown,1.0), np.where(real,tes,1.0), np.where(real,tes+err,1.0)
+        return np.where(real,tes,1.0)
+    
+    def getVariations(self, pt, dm, genmatch=5):
+        """Get down, nominal and up TES for arrays in one structured array with fields 'down', 'nom' and 'up'."""
+        return toVariations(*self.getTESArray(pt,dm,genmatch,unc='All'),dtype=scalevariations)
+    
     def getTES_highpt(self, dm, genmatch=5, unc=None):
-        """Get tau ES vs. tau DM for pt > 100 GeV"""
+        """Get tau ES vs. tau DM for pt > 100 GeV. Also accepts NumPy arrays of dm and genmatch."""
+        if isinstance(dm,np.ndarray) or isinstance(genmatch,np.ndarray):
+          return self.getTESArray_highpt(dm,genmatch,unc)
         if genmatch==5 and dm in self.DMs:
-          bin = self.hist_highpt.GetXaxis().FindBin(dm)
-          tes = self.hist_highpt.GetBinContent(bin)
-          err = self.hist_highpt.GetBinError(bin)
+          tes, err = self.table_highpt.lookup(dm)
           if unc=='Up':
             tes += err
           elif unc=='Down':
@@ -231,36 +476,57 @@ class TauESTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getTESArray_highpt(self, dm, genmatch=5, unc=None):
+        """Get tau ES vs. tau DM for pt > 100 GeV for NumPy arrays of dm and genmatch."""
+        dm, genmatch = np.broadcast_arrays(dm,genmatch)
+        bin, valid = self.tesTable_highpt.index(dm)
+        real = valid & (genmatch==5)
+        tes  = self.tesTable_highpt.values[bin]
+        err  = self.tesTable_highpt.errors[bin]
+        if unc=='Up':
+          tes = tes+err
+        elif unc=='Down':
+          tes = np.where(err<tes,tes-err,0.0) # prevent negative TES
+        elif unc=='All':
+          tesDown = np.where(err<tes,tes-err,0.0) # prevent negative TES
+          return np.where(real,tesDown,1.0), np.where(real,tes,1.0), np.where(real,tes+err,1.0)
+        return np.where(real,tes,1.0)
+    
+    def getVariations_highpt(self, dm, genmatch=5):
+        """Get down, nominal and up TES for pt > 100 GeV for arrays in one structured array."""
+        return toVariations(*self.getTESArray_highpt(dm,genmatch,unc='All'),dtype=scalevariations)
+    
 
 class TauFESTool:
     
-    def __init__(self, year, id='DeepTau2017v2p1VSe', path=datapath, verbose=False):
+    def __init__(self, year, id='DeepTau2017v2p1VSe', path=datapath, verbose=False, cache=None):
         """Choose the IDs and WPs for SFs."""
         if "UL" in year:
           print(">>> TauFESTool: Warning! Using pre-UL (%r) energy scales for e -> tau fakes..."%(year))
           year = '2016Legacy' if '2016' in year else '2017ReReco' if '2017' in year else '2018ReReco'
         assert year in campaigns, "You must choose a year from %s! Got %r."%(', '.join(campaigns),year)
         fname = os.path.join(path,"TauFES_eta-dm_%s_%s.root"%(id,year))
-        file  = ensureTFile(fname,verbose=verbose)
-        graph = file.Get('fes')
+        graph, = loadTables(fname,['fes'],cache=cache,verbose=verbose)
         FESs  = { 'barrel':  { }, 'endcap': { } }
         DMs   = [0,1]
         i     = 0
         for region in ['barrel','endcap']:
           for dm in DMs:
-            y    = graph.GetY()[i]
-            yup  = graph.GetErrorYhigh(i)
-            ylow = graph.GetErrorYlow(i)
+            y    = float(graph.y[i])
+            yup  = float(graph.errorsHigh[i])
+            ylow = float(graph.errorsLow[i])
             FESs[region][dm] = (max(0,y-ylow),y,y+yup) # prevent negative FES
             i += 1
-        file.Close()
         self.filename   = fname
         self.FESs       = FESs
         self.DMs        = [0,1]
         self.genmatches = [1,3]
+        self.fesTable   = np.array([[FESs[r][dm] for dm in DMs] for r in ['barrel','endcap']]) # region x DM x (down,nom,up)
     
     def getFES(self, eta, dm, genmatch=1, unc=None):
-        """Get electron -> tau FES vs. tau DM."""
+        """Get electron -> tau FES vs. tau DM. Also accepts NumPy arrays of eta, dm and genmatch."""
+        if isinstance(dm,np.ndarray) or isinstance(eta,np.ndarray) or isinstance(genmatch,np.ndarray):
+          return self.getFESArray(eta,dm,genmatch,unc)
         if dm in self.DMs and genmatch in self.genmatches:
           region = 'barrel' if abs(eta)<1.5 else 'endcap'
           fes    = self.FESs[region][dm]
@@ -275,3 +541,18 @@ class TauFESTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getFESArray(self, eta, dm, genmatch=1, unc=None):
+        """Get electron -> tau FES vs. tau DM for NumPy arrays of eta, dm and genmatch."""
+        eta, dm, genmatch = np.broadcast_arrays(eta,dm,genmatch)
+        bin    = np.clip(dm,0,len(self.DMs)-1).astype(np.intp)
+        real   = (bin==dm) & np.isin(genmatch,self.genmatches)
+        region = np.where(np.abs(eta)<1.5,0,1) # barrel, endcap
+        fes    = self.fesTable[region,bin]
+        if unc=='All':
+          return tuple(np.where(real,fes[...,i],1.0) for i in range(3))
+        return np.where(real,fes[...,{'Up':2,'Down':0}.get(unc,1)],1.0)
+    
+    def getVariations(self, eta, dm, genmatch=1):
+        """Get down, nominal and up FES for arrays in one structured array with fields 'down', 'nom' and 'up'."""
+        return toVariations(*self.getFESArray(eta,dm,genmatch,unc='All'),dtype=scalevariations)
+    
@@ -1,10 +1,30 @@
 from __future__ import print_function
-import os
-from ROOT import TFile, TH1
+import os, glob
+import importlib
+
+
+class LazyModule(object):
+    """Module that is only imported on first use, e.g. to avoid the startup cost of ROOT
+    in processes that never read a file or draw a plot."""
+
+    def __init__(self, name, setup=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            if self._setup:
+                self._setup(module)
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
 
 
 def ensureTFile(filename, option='READ', verbose=False):
     """Open TFile, checking if the file in the given path exists."""
+    from ROOT import TFile
     if not os.path.isfile(filename):
         raise IOError("File in path '%s' does not exist!" % (filename))
     if verbose:
@@ -30,6 +50,7 @@ def ensureFile(*paths, **kwargs):
 
 def extractTH1(file, histname, setdir=True):
     """Get histogram by name from a given file."""
+    from ROOT import TH1
     close = False
     if isinstance(file, str):
         file = ensureTFile(file, 'READ')
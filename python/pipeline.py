@@ -0,0 +1,381 @@
+# Description: Streaming evaluation of the tau corrections over chunks of large columnar inputs
+from __future__ import print_function
+import os, glob, shutil
+import zipfile
+import multiprocessing
+from timeit import default_timer as timer
+from collections import OrderedDict
+import numpy as np
+if 'CMSSW_BASE' in os.environ: # assume CMSSW environment
+  from TauPOG.TauIDSFs.sftables import toOffsets, eventProduct, isScale
+else:
+  from sftables import toOffsets, eventProduct, isScale
+
+
+class ColumnReader:
+  """Sequential reader of a column from an array (e.g. memory-mapped .npy file), or from a stream of a .npy member
+  in a .npz file. Only the values that are read are kept in memory."""
+
+  def __init__(self, array=None, stream=None):
+    self.array  = array
+    self.stream = stream
+    self.pos    = 0
+    if stream is not None:
+      version = np.lib.format.read_magic(stream)
+      if version==(1,0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(stream)
+      elif version==(2,0):
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(stream)
+      else:
+        raise ValueError("Cannot stream .npy format version %s!"%(version,))
+      if dtype.hasobject or (fortran and len(shape)>1):
+        raise ValueError("Cannot stream arrays of objects, or in Fortran order!")
+      self.dtype   = dtype
+      self.shape   = shape
+      self.rowsize = dtype.itemsize*int(np.prod(shape[1:],dtype=np.int64))
+    else:
+      self.dtype = array.dtype
+      self.shape = array.shape
+
+  def __len__(self):
+    return self.shape[0]
+
+  def read(self, n):
+    """Return the next n rows (or fewer at the end)."""
+    n = max(0,min(n,len(self)-self.pos))
+    if self.stream is not None:
+      data  = self.stream.read(n*self.rowsize)
+      if len(data)!=n*self.rowsize:
+        raise IOError("Unexpected end of stream after %d rows!"%(self.pos))
+      chunk = np.frombuffer(data,dtype=self.dtype).reshape((n,)+tuple(self.shape[1:]))
+    else:
+      chunk = self.array[self.pos:self.pos+n]
+    self.pos += n
+    return chunk
+
+  def close(self):
+    if self.stream is not None:
+      self.stream.close()
+
+
+def openColumns(source, columns=None):
+  """Open readers of columns from a .npz file, a .npy file, a directory of .npy files (one per column),
+  or a dictionary of arrays or .npy files. Files are memory-mapped or streamed, and never read in one piece.
+  Returns an ordered dictionary of ColumnReaders, and the open .npz file (or None)."""
+  readers = OrderedDict()
+  zfile   = None
+  if isinstance(source,dict):
+    for name, array in source.items():
+      if isinstance(array,str):
+        array = np.load(array,mmap_mode='r')
+      readers[name] = ColumnReader(array=array)
+  elif source.endswith('.npz'):
+    zfile = zipfile.ZipFile(source)
+    for member in zfile.namelist():
+      if member.endswith('.npy'):
+        readers[member[:-4]] = None # open stream below, only for the selected columns
+  elif source.endswith('.npy'):
+    name = os.path.basename(source)[:-4]
+    readers[name] = ColumnReader(array=np.load(source,mmap_mode='r'))
+  elif os.path.isdir(source):
+    for fname in sorted(glob.glob(os.path.join(source,"*.npy"))):
+      readers[os.path.basename(fname)[:-4]] = ColumnReader(array=np.load(fname,mmap_mode='r'))
+  else:
+    raise IOError("Cannot read columns from '%s'!"%(source))
+  if columns is not None:
+    for name in columns:
+      if name not in readers:
+        raise KeyError("Did not find column '%s' in %s!"%(name,source if isinstance(source,str) else list(source.keys())))
+    readers = OrderedDict((name,readers[name]) for name in columns)
+  if zfile is not None:
+    for name in readers:
+      readers[name] = ColumnReader(stream=zfile.open(name+'.npy'))
+  return readers, zfile
+
+
+def iterChunks(source, columns=None, chunksize=100000, counts=None):
+  """Yield dictionaries of chunks of columns (see openColumns) of at most chunksize rows.
+  If counts is the name of a column with the number of taus per event (e.g. 'nTau' in NanoAOD),
+  the chunks contain chunksize events, and all other columns are read as flat per-tau arrays."""
+  if columns is not None and counts is not None and counts not in columns:
+    columns = [counts]+list(columns)
+  readers, zfile = openColumns(source,columns)
+  try:
+    counter = readers.pop(counts) if counts is not None else None
+    while True:
+      chunk = OrderedDict()
+      if counter is not None:
+        chunk[counts] = counter.read(chunksize)
+        if len(chunk[counts])==0: break
+        nrows = int(chunk[counts].sum())
+      else:
+        nrows = chunksize
+      for name, reader in readers.items():
+        chunk[name] = reader.read(nrows)
+      lengths = set(len(chunk[name]) for name in readers)
+      if counter is None:
+        if not readers or lengths=={0}: break
+        nrows = max(lengths)
+      if lengths and lengths!={nrows}:
+        raise ValueError("Columns have different lengths at row %d!"%(max(r.pos for r in readers.values())))
+      yield chunk
+  finally:
+    for reader in readers.values():
+      reader.close()
+    if zfile is not None:
+      zfile.close()
+
+
+class CorrectionStage:
+  """Stage of a streaming pipeline that evaluates tau corrections on chunks of columns, e.g.
+    stage = CorrectionStage(counts='nTau')
+    stage.add('idsf',sftool.getVariations,['Tau_pt','Tau_genPartFlav'],event=True)
+    stage.add('tes',testool.getVariations,['Tau_pt','Tau_decayMode','Tau_genPartFlav'])
+    for weights in stage(iterChunks('taus.npz',chunksize=100000,counts='nTau')):
+      weights['idsf'], weights['idsf_event'], weights['tes']
+  Only one chunk is held in memory at a time."""
+
+  def __init__(self, counts=None):
+    self.counts      = counts
+    self.corrections = [ ] # (name, method, columns, event)
+
+  def add(self, name, method, columns, event=False):
+    """Add a correction evaluated by method on the given columns. If event is True,
+    also store the product per event as name+'_event' (needs the counts column)."""
+    if event and self.counts is None:
+      raise ValueError("Need a column with counts per event for event weights of '%s'!"%(name))
+    self.corrections.append((name,method,list(columns),event))
+    return self
+
+  @property
+  def columns(self):
+    """Columns needed by all corrections."""
+    columns = [self.counts] if self.counts is not None else [ ]
+    for name, method, args, event in self.corrections:
+      columns += [c for c in args if c not in columns]
+    return columns
+
+  def process(self, chunk):
+    """Evaluate all corrections on one chunk of columns."""
+    out = OrderedDict()
+    offsets = toOffsets(chunk[self.counts]) if self.counts is not None else None
+    for name, method, columns, event in self.corrections:
+      out[name] = method(*[chunk[c] for c in columns])
+      if event:
+        out[name+'_event'] = eventProduct(out[name],offsets)
+    return out
+
+  def __call__(self, chunks):
+    for chunk in chunks:
+      yield self.process(chunk)
+
+
+class ColumnWriter:
+  """Writer of chunks of one column into a .npy file. The chunks are appended to a temporary file,
+  which is converted to the final .npy file with the complete header when closed."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.part     = open(filename+'.part','wb')
+    self.dtype    = None
+    self.shape    = None
+    self.nrows    = 0
+
+  def write(self, chunk):
+    """Append a chunk of rows."""
+    chunk = np.ascontiguousarray(chunk)
+    if self.dtype is None:
+      self.dtype, self.shape = chunk.dtype, chunk.shape[1:]
+    elif chunk.dtype!=self.dtype or chunk.shape[1:]!=self.shape:
+      raise ValueError("Chunk of %s%s does not match column of %s%s!"%(chunk.dtype,chunk.shape[1:],self.dtype,self.shape))
+    self.part.write(chunk.tobytes())
+    self.nrows += len(chunk)
+
+  def close(self):
+    """Write the .npy file and remove the temporary file."""
+    self.part.close()
+    if self.dtype is not None:
+      header = { 'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                 'shape': (self.nrows,)+tuple(self.shape) }
+      with open(self.filename,'wb') as out, open(self.part.name,'rb') as part:
+        np.lib.format.write_array_header_1_0(out,header)
+        shutil.copyfileobj(part,out)
+    os.remove(self.part.name)
+
+
+def processFile(stage, source, output, chunksize=100000):
+  """Apply a CorrectionStage to all chunks of a source (see iterChunks), and write each of its outputs
+  to output/<name>.npy. Returns the source, the number of rows (events if counts are used, else taus),
+  and the processing time in seconds."""
+  start   = timer()
+  nrows   = 0
+  writers = OrderedDict()
+  if not os.path.isdir(output):
+    os.makedirs(output)
+  try:
+    for chunk in iterChunks(source,stage.columns,chunksize=chunksize,counts=stage.counts):
+      nrows += len(chunk[stage.counts] if stage.counts is not None else next(iter(chunk.values())))
+      for name, values in stage.process(chunk).items():
+        if name not in writers:
+          writers[name] = ColumnWriter(os.path.join(output,name+'.npy'))
+        writers[name].write(values)
+  finally:
+    for writer in writers.values():
+      writer.close()
+  return source, nrows, timer()-start
+
+
+_stage = None # stage inherited by forked workers
+
+
+def _processJob(job):
+  return processFile(_stage,*job)
+
+
+def processFiles(stage, sources, outputs, nprocs=None, chunksize=100000, verbose=True):
+  """Apply a CorrectionStage to many sources in parallel over a pool of nprocs processes (default: all cores),
+  writing the outputs of each source to the corresponding directory in outputs (see processFile).
+  The tools and their tables are created once in the parent, and inherited by the forked workers,
+  so the SF files are not read again per file. Prints the progress and throughput per file if verbose.
+  Returns a list of (source, number of rows, processing time) in the order they finished."""
+  global _stage
+  if len(sources)!=len(outputs):
+    raise ValueError("Got %d sources, but %d outputs!"%(len(sources),len(outputs)))
+  jobs    = [(source,output,chunksize) for source, output in zip(sources,outputs)]
+  nprocs  = min(nprocs or multiprocessing.cpu_count(),len(jobs))
+  results = [ ]
+  start   = timer()
+  pool    = None
+  _stage  = stage
+  try:
+    if nprocs<=1:
+      iresults = (_processJob(job) for job in jobs)
+    else:
+      context  = multiprocessing.get_context('fork') if hasattr(multiprocessing,'get_context') else multiprocessing
+      pool     = context.Pool(nprocs)
+      iresults = pool.imap_unordered(_processJob,jobs)
+    for source, nrows, time in iresults:
+      results.append((source,nrows,time))
+      if verbose:
+        print(">>> [%d/%d] %s: %d rows in %.2f s (%.4g rows/s)"%(
+              len(results),len(jobs),source,nrows,time,nrows/time if time>0 else float('inf')))
+    if pool is not None:
+      pool.close()
+      pool.join()
+  finally:
+    _stage = None
+    if pool is not None:
+      pool.terminate()
+  if verbose:
+    total = sum(r[1] for r in results)
+    time  = timer()-start
+    print(">>> Processed %d rows in %d files with %d processes in %.1f s (%.4g rows/s)"%(
+          total,len(results),nprocs,time,total/time if time>0 else float('inf')))
+  return results
+
+
+class YieldAccumulator:
+  """Sums of weights and of squared weights per category for the nominal weight, and for the down and up variation
+  of each correction, where the nominal values of the other corrections are used. Fill it chunk by chunk, e.g.
+    acc = YieldAccumulator(ncategories)
+    for weights in stage(iterChunks(...)):
+      acc.fill(category,{'idsf': weights['idsf_event']},weight=genweight)
+  and merge partial results of different chunks, processes or nodes with merge or +.
+  Energy scales (e.g. TES and FES) shift the tau pt, and move entries between categories instead of weighting them,
+  so pass the categories recomputed with the shifted pt as shifted_categories, e.g. {'tes_down': ..., 'tes_up': ...}."""
+
+  def __init__(self, ncategories):
+    self.ncategories = ncategories
+    self.sumw        = OrderedDict() # variation -> array of sums per category
+    self.sumw2       = OrderedDict()
+
+  def _add(self, name, sumw, sumw2):
+    if name in self.sumw:
+      self.sumw[name]  += sumw
+      self.sumw2[name] += sumw2
+    else:
+      self.sumw[name]  = np.array(sumw,dtype=np.float64)
+      self.sumw2[name] = np.array(sumw2,dtype=np.float64)
+
+  def _category(self, category, name):
+    category = np.asarray(category)
+    if category.size and category.max()>=self.ncategories:
+      raise ValueError("Category index %d of %s out of range for %d categories!"%(category.max(),name,self.ncategories))
+    return category
+
+  def fill(self, category, corrections, weight=None, shifted_categories=None):
+    """Add entries with a given category index (negative indices are skipped), the corrections
+    as dictionary of structured arrays with fields 'down', 'nom' and 'up' (e.g. from getVariations),
+    or plain arrays of nominal values only, and an optional base weight per entry.
+    Variations that move entries between categories (e.g. 'tes_down' and 'tes_up') are given
+    as a dictionary of category arrays in shifted_categories, and filled with the nominal weight."""
+    category = self._category(category,'nominal')
+    shifted  = OrderedDict((name,self._category(c,name)) for name, c in (shifted_categories or { }).items())
+    for name, cat in shifted.items():
+      if cat.shape!=category.shape:
+        raise ValueError("Shifted categories %s have shape %s, but nominal categories %s!"%(name,cat.shape,category.shape))
+      if name=='nom' or name in corrections or any(name in ("%s_down"%c,"%s_up"%c) for c in corrections):
+        raise ValueError("Shifted categories %s clash with the variations of the corrections!"%(name))
+    for name, values in corrections.items():
+      if isScale(values):
+        raise TypeError("Correction '%s' is an energy scale, which is not an event weight! "%(name)+
+                        "Pass the categories of the shifted taus with shifted_categories instead.")
+    base     = np.ones(len(category)) if weight is None else np.asarray(weight,dtype=np.float64)
+    values   = OrderedDict((name,np.asarray(v)) for name, v in corrections.items())
+    nominals = OrderedDict((name,v['nom'] if v.dtype.names else v) for name, v in values.items())
+    def product(skip=None): # base weight times nominal values of all other corrections
+      prod = base
+      for name, nom in nominals.items():
+        if name!=skip:
+          prod = prod*nom
+      return prod
+    def bincount(cat, w):
+      keep = cat>=0
+      return np.bincount(cat[keep],weights=w[keep],minlength=self.ncategories)
+    nominal = product()
+    self._add('nom',bincount(category,nominal),bincount(category,nominal**2))
+    for name, vals in values.items():
+      if not vals.dtype.names: continue
+      others = product(skip=name)
+      for var in ['down','up']:
+        w = others*vals[var]
+        self._add("%s_%s"%(name,var),bincount(category,w),bincount(category,w**2))
+    for name, cat in shifted.items():
+      self._add(name,bincount(cat,nominal),bincount(cat,nominal**2))
+    return self
+
+  def merge(self, other):
+    """Add the sums of another accumulator to this one."""
+    if other.ncategories!=self.ncategories:
+      raise ValueError("Cannot merge accumulators with %d and %d categories!"%(self.ncategories,other.ncategories))
+    if self.sumw and other.sumw and set(self.sumw.keys())!=set(other.sumw.keys()):
+      raise ValueError("Cannot merge accumulators with different variations: %s vs. %s!"%(
+                       ', '.join(self.sumw.keys()),', '.join(other.sumw.keys())))
+    for name in other.sumw:
+      self._add(name,other.sumw[name],other.sumw2[name])
+    return self
+
+  def __add__(self, other):
+    return YieldAccumulator(self.ncategories).merge(self).merge(other)
+
+  def __iadd__(self, other):
+    return self.merge(other)
+
+  def write(self, filename):
+    """Write sums to a .npz file, e.g. to merge results of different nodes later."""
+    arrays = { 'ncategories': np.array(self.ncategories) }
+    for name in self.sumw:
+      arrays['sumw_'+name]  = self.sumw[name]
+      arrays['sumw2_'+name] = self.sumw2[name]
+    np.savez(filename,**arrays)
+
+  @classmethod
+  def read(cls, filename):
+    """Read sums from a .npz file."""
+    with np.load(filename) as npzfile:
+      acc = cls(int(npzfile['ncategories']))
+      for key in npzfile.files:
+        if key.startswith('sumw_'):
+          name = key[len('sumw_'):]
+          acc._add(name,npzfile[key],npzfile['sumw2_'+name])
+    return acc
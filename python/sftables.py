@@ -0,0 +1,967 @@
+# Description: NumPy tables for vectorized evaluation of the tau ID SFs, TES and FES
+from __future__ import print_function
+import os, re, json
+import weakref
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+
+class PiecewiseFunction:
+  """Piecewise-linear function f(x) = intercepts[i] + slopes[i]*x, with bin i between edges[i-1] and edges[i].
+  Bins include their upper edge, (lo,hi], if right=True, else their lower edge, [lo,hi)."""
+
+  def __init__(self, edges, intercepts, slopes, right=True, name=None):
+    self.edges      = np.asarray(edges,dtype=np.float64)
+    self.intercepts = np.asarray(intercepts,dtype=np.float64)
+    self.slopes     = np.asarray(slopes,dtype=np.float64)
+    self.right      = right
+    self.name       = name
+    assert len(self.intercepts)==len(self.slopes)==len(self.edges)+1, "Need one more bin than edges!"
+    self._side      = 'left' if right else 'right'
+    self._bisect    = bisect_left if right else bisect_right
+    self._edgelist  = self.edges.tolist() # python lists for fast scalar evaluation
+    self._intlist   = self.intercepts.tolist()
+    self._slopelist = self.slopes.tolist()
+
+  def findBin(self, x):
+    """Return index of the bin for each x."""
+    return np.searchsorted(self.edges,x,side=self._side)
+
+  def __call__(self, x):
+    """Evaluate for an array of x."""
+    x   = np.asarray(x,dtype=np.float64)
+    bin = self.findBin(x)
+    return self.intercepts[bin] + self.slopes[bin]*x
+
+  def Eval(self, x):
+    """Evaluate for a single x, like TF1::Eval."""
+    bin = self._bisect(self._edgelist,x)
+    return self._intlist[bin] + self._slopelist[bin]*x
+
+  def toArrays(self):
+    return { 'edges': self.edges, 'intercepts': self.intercepts, 'slopes': self.slopes, 'right': np.array(self.right) }
+
+  @classmethod
+  def fromArrays(cls, arrays, name=None):
+    return cls(arrays['edges'],arrays['intercepts'],arrays['slopes'],right=bool(arrays['right']),name=name)
+
+
+_condrexp = re.compile(r'^x(<=|>=|<|>)([-+]?\d*\.?\d*(?:[eE][-+]?\d+)?)$')
+_exprrexp = re.compile(r'^[-+*/().\deEx]+$')
+
+def _splitTopLevel(string, sep):
+  """Split string on separator outside of parentheses."""
+  parts, depth, last = [ ], 0, 0
+  for i, char in enumerate(string):
+    if char=='(':
+      depth += 1
+    elif char==')':
+      depth -= 1
+    elif char==sep and depth==0 and i>last and string[i-1] not in '*/eE': # skip signs
+      parts.append(string[last:i])
+      last = i+1
+  parts.append(string[last:])
+  return parts
+
+
+def _stripParentheses(string):
+  """Strip enclosing parentheses."""
+  while string.startswith('(') and string.endswith(')'):
+    depth = 0
+    for i, char in enumerate(string):
+      depth += (char=='(') - (char==')')
+      if depth==0 and i<len(string)-1: # first parenthesis closes before the end
+        return string
+    string = string[1:-1]
+  return string
+
+
+def _evalExpr(expr, x):
+  return float(eval(expr,{'__builtins__':{}},{'x':x}))
+
+
+def compileFormula(formula, name=None):
+  """Compile a piecewise formula like '(x<=20)*0+(x>20&&x<=25)*0.98+(x>500&&x<=1000)*(0.9+0.04*(x/500.))'
+  into a PiecewiseFunction. Each term must be the product of a condition on x and an expression linear in x."""
+  formula = formula.replace(' ','')
+  pieces  = [ ] # (lo, hi, expression)
+  right   = None
+  for term in _splitTopLevel(formula,'+'):
+    conds, exprs = [ ], [ ]
+    for factor in _splitTopLevel(term,'*'):
+      factor = _stripParentheses(factor)
+      if '<' in factor or '>' in factor:
+        conds.extend(factor.split('&&'))
+      else:
+        exprs.append("(%s)"%factor)
+    if len(conds)==0 or not exprs:
+      raise ValueError("Could not parse term %r of formula %r!"%(term,formula))
+    lo, hi = -np.inf, np.inf
+    for cond in conds:
+      match = _condrexp.match(_stripParentheses(cond))
+      if not match:
+        raise ValueError("Could not parse condition %r of formula %r!"%(cond,formula))
+      op, val = match.group(1), float(match.group(2))
+      if op in ['>','>=']:
+        lo = val
+      else:
+        hi = val
+      incl = (op in ['<=','>']) # upper edge included
+      if right not in [None,incl]:
+        raise ValueError("Mixed bin edge conventions in formula %r!"%(formula))
+      right = incl
+    expr = '*'.join(exprs)
+    if not _exprrexp.match(expr):
+      raise ValueError("Could not parse expression %r of formula %r!"%(expr,formula))
+    pieces.append((lo,hi,expr))
+  pieces.sort(key=lambda p: p[0])
+  edges, intercepts, slopes = [ ], [ ], [ ]
+  xlast = -np.inf
+  for lo, hi, expr in pieces:
+    if lo<xlast:
+      raise ValueError("Overlapping terms in formula %r!"%(formula))
+    if lo>xlast: # gap: formula evaluates to zero
+      edges.append(lo)
+      intercepts.append(0.)
+      slopes.append(0.)
+    if hi<=lo:
+      raise ValueError("Empty term in formula %r!"%(formula))
+    x0 = lo if np.isfinite(lo) else (hi-1000. if np.isfinite(hi) else 0.)
+    x1 = hi if np.isfinite(hi) else x0+1000.
+    y0, y1 = _evalExpr(expr,x0), _evalExpr(expr,x1)
+    slope  = (y1-y0)/(x1-x0)
+    if abs(_evalExpr(expr,(x0+x1)/2.)-(y0+y1)/2.)>1e-9*(1+abs(y0)+abs(y1)):
+      raise ValueError("Expression %r of formula %r is not linear in x!"%(expr,formula))
+    if slope==0:
+      intercepts.append(y0)
+    else:
+      intercepts.append(y0-slope*x0)
+    slopes.append(slope)
+    if np.isfinite(hi):
+      edges.append(hi)
+    xlast = hi
+  if np.isfinite(xlast): # formula evaluates to zero above last term
+    intercepts.append(0.)
+    slopes.append(0.)
+  if edges and not np.isfinite(edges[0]):
+    edges, intercepts, slopes = edges[1:], intercepts[1:], slopes[1:]
+  return PiecewiseFunction(edges,intercepts,slopes,right=(right!=False),name=name)
+
+
+def validateTF1(func, pwfunc, npoints=1000, tolerance=1e-9):
+  """Check a compiled PiecewiseFunction against TF1::Eval on a dense grid spanning all edges with a margin,
+  and just below, on and above each edge. Returns the maximum deviation, or raises ValueError if it is too large."""
+  edges = pwfunc.edges
+  if len(edges):
+    margin = max(1.,0.1*(edges[-1]-edges[0]))
+    points = np.concatenate([np.linspace(edges[0]-margin,edges[-1]+margin,npoints),edges,edges-1e-3,edges+1e-3])
+  else:
+    points = np.linspace(-1000.,1000.,npoints)
+  maxdev = 0.
+  for x in points.tolist():
+    ref = func.Eval(x)
+    dev = abs(pwfunc.Eval(x)-ref)
+    if dev>tolerance*(1+abs(ref)):
+      raise ValueError("Compiled %r does not match TF1::Eval(%s) = %s!"%(str(func.GetExpFormula()),x,ref))
+    maxdev = max(maxdev,dev)
+  return maxdev
+
+
+def compileTF1(func, npoints=1000):
+  """Compile a piecewise ROOT TF1 into a PiecewiseFunction, validated against TF1::Eval (see validateTF1)."""
+  formula = str(func.GetExpFormula())
+  pwfunc  = compileFormula(formula,name=func.GetName())
+  validateTF1(func,pwfunc,npoints=npoints)
+  return pwfunc
+
+
+class VectorizedTF1:
+  """Fallback for TF1s that cannot be compiled: call TF1::Eval for each element."""
+
+  def __init__(self, func):
+    self.func = func
+    self.name = func.GetName()
+
+  def __call__(self, x):
+    x = np.asarray(x,dtype=np.float64)
+    return np.fromiter((self.func.Eval(v) for v in x.flat),dtype=np.float64,count=x.size).reshape(x.shape)
+
+  def Eval(self, x):
+    return self.func.Eval(x)
+
+
+def vectorizeTF1(func, verbose=False):
+  """Return vectorized version of a TF1: compiled if possible, else looping over TF1::Eval."""
+  try:
+    return compileTF1(func)
+  except ValueError as error:
+    if verbose:
+      print(">>> vectorizeTF1: Could not compile %r, falling back to TF1::Eval: %s"%(func.GetName(),error))
+    return VectorizedTF1(func)
+
+
+# energy scales shift the tau pt, and are not weights: mark them with field titles, which are also stored in .npy files
+variations      = np.dtype([('down',np.float64),('nom',np.float64),('up',np.float64)])
+scalevariations = np.dtype([(('energy scale '+f,f),np.float64) for f in ['down','nom','up']])
+
+
+def toVariations(down, nom, up, dtype=variations):
+  """Pack arrays of down, nominal and up variations into one structured array with fields 'down', 'nom' and 'up'.
+  Use dtype=scalevariations for energy scales."""
+  out = np.empty(np.shape(nom),dtype=dtype)
+  out['down'] = down
+  out['nom']  = nom
+  out['up']   = up
+  return out
+
+
+def isScale(values):
+  """Return True if values are variations of an energy scale (see toVariations), which shift the tau pt,
+  and are not weights. Also works for arrays read back from .npy or .npz files."""
+  fields = getattr(getattr(values,'dtype',None),'fields',None)
+  return bool(fields) and 'nom' in fields and fields['nom'][2:]==('energy scale nom',)
+
+
+def toOffsets(counts):
+  """Convert the number of objects per event (e.g. nTau in NanoAOD) into offsets of length nevents+1."""
+  offsets = np.zeros(len(counts)+1,dtype=np.int64)
+  np.cumsum(counts,out=offsets[1:])
+  return offsets
+
+
+def eventProduct(values, offsets):
+  """Multiply the flat per-object values of each event, given the event offsets. Empty events get 1.
+  Structured arrays (e.g. of variations) are multiplied field by field."""
+  offsets = np.asarray(offsets)
+  if offsets.ndim!=1 or len(offsets)<1 or offsets[0]!=0 or offsets[-1]!=len(values):
+    raise ValueError("Offsets must start at 0 and end at the number of values (%d)!"%(len(values)))
+  if values.dtype.names:
+    out = np.empty(len(offsets)-1,dtype=values.dtype)
+    for field in values.dtype.names:
+      out[field] = eventProduct(values[field],offsets)
+    return out
+  counts = np.diff(offsets)
+  filled = counts>0
+  out = np.ones(len(counts),dtype=np.result_type(values.dtype,np.float64))
+  if filled.any(): # reduceat does not handle empty events, so only reduce from the start of filled ones
+    out[filled] = np.multiply.reduceat(values,offsets[:-1][filled])
+  return out
+
+
+class DMTable:
+  """Dense lookup table of values and errors indexed by tau decay mode. Only the supported DMs are valid."""
+
+  def __init__(self, DMs, values, errors):
+    self.DMs    = list(DMs)
+    self.values = np.asarray(values,dtype=np.float64)
+    self.errors = np.asarray(errors,dtype=np.float64)
+    self.valid  = np.zeros(len(self.values),dtype=bool)
+    self.valid[self.DMs] = True
+
+  @classmethod
+  def fromTH1Table(cls, hist, DMs):
+    """Read content and error of the bin of each supported DM from a TH1Table."""
+    values = np.zeros(max(DMs)+1)
+    errors = np.zeros(max(DMs)+1)
+    for dm in DMs:
+      values[dm], errors[dm] = hist.lookup(dm)
+    return cls(DMs,values,errors)
+
+  def index(self, dm):
+    """Return table index for an array of DMs, and a mask of supported DMs."""
+    dm    = np.asarray(dm)
+    index = np.clip(dm,0,len(self.values)-1).astype(np.intp)
+    return index, (index==dm) & self.valid[index]
+
+
+class TH1Table:
+  """Bin edges, contents and errors of a TH1, including under- and overflow bins."""
+
+  def __init__(self, edges, values, errors):
+    self.edges  = np.asarray(edges,dtype=np.float64)
+    self.values = np.asarray(values,dtype=np.float64)
+    self.errors = np.asarray(errors,dtype=np.float64)
+    assert len(self.values)==len(self.errors)==len(self.edges)+1, "Need contents for under- and overflow bins!"
+    self._edgelist  = self.edges.tolist() # python lists for fast scalar lookup
+    self._valuelist = self.values.tolist()
+    self._errorlist = self.errors.tolist()
+
+  @classmethod
+  def fromTH1(cls, hist):
+    """Read bin edges, contents and errors from a TH1."""
+    axis   = hist.GetXaxis()
+    nbins  = axis.GetNbins()
+    edges  = [axis.GetBinLowEdge(i) for i in range(1,nbins+2)]
+    values = [hist.GetBinContent(i) for i in range(0,nbins+2)]
+    errors = [hist.GetBinError(i) for i in range(0,nbins+2)]
+    return cls(edges,values,errors)
+
+  def findBin(self, x):
+    """Return bin index for an array of x, like TAxis::FindBin (0 for underflow, nbins+1 for overflow)."""
+    return np.searchsorted(self.edges,x,side='right')
+
+  def lookup(self, x):
+    """Return content and error of the bin of a single x."""
+    bin = bisect_right(self._edgelist,x)
+    return self._valuelist[bin], self._errorlist[bin]
+
+  def toArrays(self):
+    return { 'edges': self.edges, 'values': self.values, 'errors': self.errors }
+
+  @classmethod
+  def fromArrays(cls, arrays, name=None):
+    return cls(arrays['edges'],arrays['values'],arrays['errors'])
+
+
+class GraphTable:
+  """Points and asymmetric errors of a TGraphAsymmErrors."""
+
+  def __init__(self, x, y, errorsLow, errorsHigh):
+    self.x          = np.asarray(x,dtype=np.float64)
+    self.y          = np.asarray(y,dtype=np.float64)
+    self.errorsLow  = np.asarray(errorsLow,dtype=np.float64)
+    self.errorsHigh = np.asarray(errorsHigh,dtype=np.float64)
+
+  @classmethod
+  def fromGraph(cls, graph):
+    """Read points and errors from a TGraphAsymmErrors."""
+    npoints = graph.GetN()
+    x       = [graph.GetX()[i] for i in range(npoints)]
+    y       = [graph.GetY()[i] for i in range(npoints)]
+    errLow  = [graph.GetErrorYlow(i) for i in range(npoints)]
+    errHigh = [graph.GetErrorYhigh(i) for i in range(npoints)]
+    return cls(x,y,errLow,errHigh)
+
+  def toArrays(self):
+    return { 'x': self.x, 'y': self.y, 'errorsLow': self.errorsLow, 'errorsHigh': self.errorsHigh }
+
+  @classmethod
+  def fromArrays(cls, arrays, name=None):
+    return cls(arrays['x'],arrays['y'],arrays['errorsLow'],arrays['errorsHigh'])
+
+
+class StackedTable:
+  """Several tables of the same kind (e.g. of all WPs) on the union of their bin edges, so that all of them
+  are evaluated for an array of x with one search and one gather into arrays of shape x.shape+(ntables,).
+  The columns (e.g. 'values' and 'errors') have one row per bin, including under- and overflow, and one column per table."""
+
+  def __init__(self, edges, columns, side='right'):
+    self.edges   = np.asarray(edges,dtype=np.float64)
+    self.columns = OrderedDict((k,np.asarray(v,dtype=np.float64)) for k, v in columns.items())
+    self.side    = side
+    assert all(len(v)==len(self.edges)+1 for v in self.columns.values()), "Need one more bin than edges!"
+
+  @staticmethod
+  def _representatives(edges):
+    """Return one point inside each bin of the union edges, including under- and overflow."""
+    if len(edges)==0:
+      return np.zeros(1)
+    return np.concatenate([[edges[0]-1.],0.5*(edges[1:]+edges[:-1]),[edges[-1]+1.]])
+
+  @classmethod
+  def fromTH1Tables(cls, tables):
+    """Stack contents and errors of TH1Tables."""
+    edges  = np.unique(np.concatenate([t.edges for t in tables]))
+    points = cls._representatives(edges)
+    bins   = [t.findBin(points) for t in tables]
+    values = np.stack([t.values[b] for t, b in zip(tables,bins)],axis=-1)
+    errors = np.stack([t.errors[b] for t, b in zip(tables,bins)],axis=-1)
+    return cls(edges,OrderedDict([('values',values),('errors',errors)]),side='right')
+
+  @classmethod
+  def fromFunctions(cls, funcs):
+    """Stack intercepts and slopes of compiled PiecewiseFunctions with the same bin convention."""
+    if not all(isinstance(f,PiecewiseFunction) for f in funcs):
+      raise TypeError("Can only stack compiled piecewise functions!")
+    if len(set(f.right for f in funcs))!=1:
+      raise ValueError("Cannot stack functions with different bin edge conventions!")
+    edges  = np.unique(np.concatenate([f.edges for f in funcs]))
+    points = cls._representatives(edges)
+    bins   = [f.findBin(points) for f in funcs]
+    intercepts = np.stack([f.intercepts[b] for f, b in zip(funcs,bins)],axis=-1)
+    slopes     = np.stack([f.slopes[b] for f, b in zip(funcs,bins)],axis=-1)
+    return cls(edges,OrderedDict([('intercepts',intercepts),('slopes',slopes)]),side=funcs[0]._side)
+
+  def findBin(self, x):
+    """Return index of the union bin for each x."""
+    return np.searchsorted(self.edges,x,side=self.side)
+
+  def __call__(self, x):
+    """Evaluate stacked piecewise-linear functions for an array of x."""
+    x   = np.asarray(x,dtype=np.float64)
+    bin = self.findBin(x)
+    return self.columns['intercepts'][bin] + self.columns['slopes'][bin]*x[...,None]
+
+
+class ScoreTable:
+  """SFs in bins of a variable (e.g. pT or DM) and of the tau ID score, with down, central and up values,
+  as in the TF2s of ScoreSFTool.DumpSFTF2. Variable bins are [lo,hi), and score bins [lo,next lo) within their
+  variable bin; the last bins are unbounded from above. The SF is 0 outside all bins."""
+
+  def __init__(self, varLow, varHigh, scoreRows, scoreEdges, values):
+    self.varLow     = np.asarray(varLow,dtype=np.float64)
+    self.varHigh    = np.asarray(varHigh,dtype=np.float64)
+    self.scoreRows  = np.asarray(scoreRows,dtype=np.int64) # variable bin of each score bin
+    self.scoreEdges = np.asarray(scoreEdges,dtype=np.float64)
+    self.values     = np.asarray(values,dtype=np.float64).reshape(-1,3) # down, central, up
+    assert np.all(np.diff(self.varLow)>0), "Variable bins must be ordered!"
+    assert len(self.scoreRows)==len(self.scoreEdges)==len(self.values), "Need one row, edge and values per score bin!"
+    # complex numbers are ordered lexicographically: by variable bin, then by score edge
+    self._keys = self.scoreRows+1j*self.scoreEdges
+    assert np.all(self._keys[1:]>self._keys[:-1]), "Score bins must be ordered!"
+
+  def findBin(self, x, score):
+    """Return the score bin for arrays of x and score, and a mask of values inside the bins."""
+    x, score = np.broadcast_arrays(np.asarray(x,dtype=np.float64),np.asarray(score,dtype=np.float64))
+    row   = np.searchsorted(self.varLow,x,side='right')-1
+    row   = np.maximum(row,0)
+    valid = (x>=self.varLow[row]) & (x<self.varHigh[row])
+    bin   = np.searchsorted(self._keys,row+1j*score,side='right')-1
+    bin   = np.maximum(bin,0)
+    valid &= (self.scoreRows[bin]==row) & (score>=self.scoreEdges[bin])
+    return bin, valid
+
+  def __call__(self, x, score, unc=None):
+    """Evaluate SF for arrays of x and score. Use unc='Up' or 'Down' for variations, or 'All' for all three."""
+    bin, valid = self.findBin(x,score)
+    if unc=='All':
+      values = self.values[bin]
+      return tuple(np.where(valid,values[...,i],0.0) for i in range(3))
+    return np.where(valid,self.values[bin,{'Down':0,'Up':2}.get(unc,1)],0.0)
+
+  def getVariations(self, x, score):
+    """Get down, nominal and up SFs in one structured array with fields 'down', 'nom' and 'up'."""
+    return toVariations(*self(x,score,unc='All'))
+
+  def toArrays(self):
+    return { 'varLow': self.varLow, 'varHigh': self.varHigh, 'scoreRows': self.scoreRows,
+             'scoreEdges': self.scoreEdges, 'values': self.values }
+
+  @classmethod
+  def fromArrays(cls, arrays, name=None):
+    return cls(arrays['varLow'],arrays['varHigh'],arrays['scoreRows'],arrays['scoreEdges'],arrays['values'])
+
+  def write(self, filename):
+    """Write to a .npz file."""
+    np.savez(filename,**self.toArrays())
+
+  @classmethod
+  def read(cls, filename):
+    """Read from a .npz file."""
+    with np.load(filename) as npzfile:
+      return cls.fromArrays(npzfile)
+
+
+class CubicSpline:
+  """Cubic spline through knots (x, y) with not-a-knot end conditions, as ROOT.TSpline3 without end-point
+  derivatives, evaluated for arrays without ROOT. Outside the knots, the first and last polynomial pieces
+  are extrapolated, as in TSpline3::Eval. On [x[i],x[i+1]], the spline is y[i]+b[i]*t+c[i]*t**2+d[i]*t**3, t=x-x[i]."""
+
+  def __init__(self, x, y, b=None, c=None, d=None):
+    self.x = np.asarray(x,dtype=np.float64)
+    self.y = np.asarray(y,dtype=np.float64)
+    assert len(self.x)==len(self.y)>=1, "Need the same number of x and y values, and at least one knot!"
+    assert np.all(np.diff(self.x)>0), "Knots must be ordered!"
+    if b is None:
+      b, c, d = self.fit(self.x,self.y)
+    self.b = np.asarray(b,dtype=np.float64)
+    self.c = np.asarray(c,dtype=np.float64)
+    self.d = np.asarray(d,dtype=np.float64)
+
+  @classmethod
+  def fromHistogram(cls, edges, contents):
+    """Spline through the bin centers and contents of a histogram (without under- and overflow),
+    as ROOT.TSpline3 built from a TH1."""
+    edges = np.asarray(edges,dtype=np.float64)
+    return cls((edges[:-1]+edges[1:])/2.,contents)
+
+  @staticmethod
+  def fit(x, y):
+    """Return coefficients b, c and d of the polynomial pieces between the knots."""
+    n = len(x)
+    if n==1: # constant
+      return np.zeros(1), np.zeros(1), np.zeros(1)
+    h     = np.diff(x)
+    delta = np.diff(y)/h
+    if n==2: # straight line
+      slopes = np.array([delta[0],delta[0]])
+    elif n==3: # not-a-knot on both ends of one interior knot: parabola
+      c = (delta[1]-delta[0])/(x[2]-x[0])
+      slopes = np.array([delta[0]-c*h[0],delta[0]+c*h[0],delta[1]+c*h[1]])
+    else: # solve for the slopes at the knots, with continuous third derivative at the second and next-to-last knots
+      A = np.zeros((n,n))
+      r = np.zeros(n)
+      i = np.arange(1,n-1)
+      A[i,i-1] = h[1:]
+      A[i,i]   = 2*(h[:-1]+h[1:])
+      A[i,i+1] = h[:-1]
+      r[i]     = 3*(h[1:]*delta[:-1]+h[:-1]*delta[1:])
+      A[0,0], A[0,1] = h[1], h[0]+h[1]
+      r[0]     = ((h[0]+2*(h[0]+h[1]))*h[1]*delta[0]+h[0]**2*delta[1])/(h[0]+h[1])
+      A[-1,-2], A[-1,-1] = h[-1]+h[-2], h[-2]
+      r[-1]    = (h[-1]**2*delta[-2]+(2*(h[-2]+h[-1])+h[-1])*h[-2]*delta[-1])/(h[-2]+h[-1])
+      slopes   = np.linalg.solve(A,r)
+    c = (3*delta-2*slopes[:-1]-slopes[1:])/h
+    d = (slopes[:-1]+slopes[1:]-2*delta)/h**2
+    return slopes[:-1], c, d
+
+  def findBin(self, x):
+    """Return polynomial piece for array of x, extrapolating the first and last piece."""
+    return np.clip(np.searchsorted(self.x,x,side='right')-1,0,max(len(self.x)-2,0))
+
+  def __call__(self, x):
+    """Evaluate spline for an array of x."""
+    x   = np.asarray(x,dtype=np.float64)
+    bin = self.findBin(x)
+    t   = x-self.x[bin]
+    return self.y[bin]+t*(self.b[bin]+t*(self.c[bin]+t*self.d[bin]))
+
+  def toArrays(self):
+    return { 'x': self.x, 'y': self.y, 'b': self.b, 'c': self.c, 'd': self.d }
+
+  @classmethod
+  def fromArrays(cls, arrays, name=None):
+    return cls(arrays['x'],arrays['y'],arrays['b'],arrays['c'],arrays['d'])
+
+
+class ScoreSplineTable:
+  """Smooth SFs vs. the tau ID score with a CubicSpline per bin of a variable (e.g. pT or DM),
+  as from ScoreSFTool.FitSpline. Variable bins are [lo,hi); the SF is 0 outside all bins.
+  Taus are evaluated with one batched call per variable bin."""
+
+  def __init__(self, varLow, varHigh, splines):
+    self.varLow  = np.asarray(varLow,dtype=np.float64)
+    self.varHigh = np.asarray(varHigh,dtype=np.float64)
+    self.splines = list(splines)
+    assert np.all(np.diff(self.varLow)>0), "Variable bins must be ordered!"
+    assert len(self.varLow)==len(self.varHigh)==len(self.splines), "Need one spline per variable bin!"
+
+  def findBin(self, x):
+    """Return the variable bin for an array of x, and a mask of values inside the bins."""
+    x     = np.asarray(x,dtype=np.float64)
+    row   = np.maximum(np.searchsorted(self.varLow,x,side='right')-1,0)
+    valid = (x>=self.varLow[row]) & (x<self.varHigh[row])
+    return row, valid
+
+  def __call__(self, x, score):
+    """Evaluate SF for arrays of x and score."""
+    x, score   = np.broadcast_arrays(np.asarray(x,dtype=np.float64),np.asarray(score,dtype=np.float64))
+    row, valid = self.findBin(x.ravel())
+    score      = score.ravel()
+    index      = np.flatnonzero(valid)
+    order      = index[np.argsort(row[index],kind='stable')] # taus grouped by variable bin
+    stops      = np.cumsum(np.bincount(row[index],minlength=len(self.splines)))
+    sfs = np.zeros(len(score))
+    for spline, start, stop in zip(self.splines,np.append(0,stops[:-1]),stops):
+      if stop>start:
+        sfs[order[start:stop]] = spline(score[order[start:stop]])
+    return sfs.reshape(x.shape)
+
+  def toArrays(self):
+    rows = np.concatenate([np.full(len(s.x),i) for i, s in enumerate(self.splines)]) if self.splines else np.zeros(0)
+    arrays = { 'varLow': self.varLow, 'varHigh': self.varHigh, 'knotRows': rows }
+    for key in ['x','y','b','c','d']:
+      # pad coefficients of pieces to one per knot, so all arrays share the knot rows
+      arrays[key] = np.concatenate([np.append(getattr(s,key),np.zeros(len(s.x)-len(getattr(s,key)))) for s in self.splines]) \
+                    if self.splines else np.zeros(0)
+    return arrays
+
+  @classmethod
+  def fromArrays(cls, arrays, name=None):
+    rows, splines = np.asarray(arrays['knotRows']), [ ]
+    for i in range(len(arrays['varLow'])):
+      mask  = rows==i
+      x, y  = arrays['x'][mask], arrays['y'][mask]
+      npoly = max(len(x)-1,1)
+      splines.append(CubicSpline(x,y,*[arrays[k][mask][:npoly] for k in ['b','c','d']]))
+    return cls(arrays['varLow'],arrays['varHigh'],splines)
+
+  def write(self, filename):
+    """Write to a .npz file."""
+    np.savez(filename,**self.toArrays())
+
+  @classmethod
+  def read(cls, filename):
+    """Read from a .npz file."""
+    with np.load(filename) as npzfile:
+      return cls.fromArrays(npzfile)
+
+
+tabletypes = OrderedDict([ ('TH1',TH1Table), ('TF1',PiecewiseFunction), ('graph',GraphTable), ('score',ScoreTable),
+                           ('spline',CubicSpline), ('scorespline',ScoreSplineTable) ])
+
+
+def toTable(obj, verbose=False):
+  """Convert a ROOT TH1, TF1 or TGraphAsymmErrors into a table."""
+  if obj.InheritsFrom('TH1'):
+    return TH1Table.fromTH1(obj)
+  elif obj.InheritsFrom('TF1'):
+    return vectorizeTF1(obj,verbose=verbose)
+  elif obj.InheritsFrom('TGraphAsymmErrors'):
+    return GraphTable.fromGraph(obj)
+  raise TypeError("Cannot convert %r of type %s to a table!"%(obj.GetName(),obj.ClassName()))
+
+
+def _openTFile(filename, verbose=False):
+  """Open a ROOT file. This is the only place where ROOT is imported."""
+  if 'CMSSW_BASE' in os.environ: # assume CMSSW environment
+    from TauPOG.TauIDSFs.helpers import ensureTFile
+  else:
+    from helpers import ensureTFile
+  return ensureTFile(filename,verbose=verbose)
+
+
+def _listKeys(file):
+  """Return names of all objects in an open ROOT file, skipping other cycles."""
+  names = [ ]
+  for key in file.GetListOfKeys():
+    if key.GetName() not in names:
+      names.append(key.GetName())
+  return names
+
+
+def readTables(filename, names=None, verbose=False):
+  """Read objects from a ROOT file into an ordered dictionary of tables. By default, read all objects."""
+  file = _openTFile(filename,verbose=verbose)
+  if names is None:
+    names = _listKeys(file)
+  tables = OrderedDict()
+  for name in names:
+    obj = file.Get(name)
+    if not obj:
+      raise IOError("Did not find object '%s' in file '%s'!"%(name,filename))
+    tables[name] = toTable(obj,verbose=verbose)
+  file.Close()
+  return tables
+
+
+def readObjects(filename, names, verbose=False):
+  """Read the original ROOT objects (e.g. TH1, TF1) from a ROOT file, detached from the file."""
+  file = _openTFile(filename,verbose=verbose)
+  objs = [ ]
+  for name in names:
+    obj = file.Get(name)
+    if not obj:
+      raise IOError("Did not find object '%s' in file '%s'!"%(name,filename))
+    if obj.InheritsFrom('TH1'):
+      obj.SetDirectory(0)
+    objs.append(obj)
+  file.Close()
+  return objs
+
+
+def listTables(filename, cache=None, verbose=False):
+  """Return names of all objects in a ROOT file, or of that file in a cache (SFCache or path)."""
+  if cache is None:
+    file  = _openTFile(filename,verbose=verbose)
+    names = _listKeys(file)
+    file.Close()
+    return names
+  cache = getCache(cache,verbose=verbose)
+  fname = os.path.basename(filename)
+  names = [name for f, name in cache.index if f==fname]
+  if not names:
+    raise IOError("Did not find file '%s' in cache '%s'!"%(fname,cache.filename))
+  return names
+
+
+_flatmagic   = b'TauSFTab'
+_flatversion = 1
+_flatheader  = np.dtype([('magic','S8'),('version','<u4'),('length','<u4')])
+_flatalign   = 64
+
+
+def _flatHeader(index):
+  """Return the header of a flat binary file: a fixed part with the magic string, version and length of
+  the JSON index, followed by the index padded to a multiple of 64 bytes."""
+  header = json.dumps(index).encode('utf-8')
+  start  = _flatheader.itemsize+len(header)
+  header += b' '*(-start%_flatalign)
+  return np.array((_flatmagic,_flatversion,len(header)),dtype=_flatheader).tobytes()+header
+
+
+def _readFlatHeader(read, source):
+  """Read the header of a flat binary file with a function returning the next n bytes.
+  Returns index and offset of the data in bytes."""
+  magic, version, length = np.frombuffer(read(_flatheader.itemsize),dtype=_flatheader)[0]
+  if magic!=_flatmagic or version!=_flatversion:
+    raise IOError("'%s' is not a flat SF table file of version %d!"%(source,_flatversion))
+  index = json.loads(read(length).decode('utf-8'))
+  return index, _flatheader.itemsize+length
+
+
+def _writeFlat(filename, data, index):
+  """Write data array and index to a flat binary file: the header, and the data as little-endian float64."""
+  with open(filename,'wb') as file:
+    file.write(_flatHeader(index))
+    file.write(np.ascontiguousarray(data,dtype='<f8').tobytes())
+
+
+def _mapFlat(filename):
+  """Memory-map the data of a flat binary file read-only, without copying. Returns data and index."""
+  with open(filename,'rb') as file:
+    index, offset = _readFlatHeader(file.read,filename)
+  if os.path.getsize(filename)==offset: # np.memmap cannot map empty data
+    return np.zeros(0), index
+  return np.memmap(filename,dtype='<f8',mode='r',offset=offset), index
+
+
+_SharedMemory = None
+
+
+def _sharedMemory(name=None, size=0):
+  """Create (if size>0) or attach to a named block of shared memory (Python 3.8+)."""
+  global _SharedMemory
+  if _SharedMemory is None:
+    try:
+      from multiprocessing import shared_memory
+    except ImportError:
+      raise ImportError("Shared-memory tables need multiprocessing.shared_memory of Python 3.8 or newer!")
+    class _SharedMemory(shared_memory.SharedMemory):
+      def close(self):
+        try:
+          super(_SharedMemory,self).close()
+        except BufferError: # tables still refer to the block; it is unmapped at exit
+          pass
+  if size>0:
+    return _SharedMemory(name=name,create=True,size=size)
+  try: # Python 3.13+: do not let the resource tracker unlink the block of the owner when this process exits
+    return _SharedMemory(name=name,track=False)
+  except TypeError: # older versions always register the block, so skip that while attaching
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+      return _SharedMemory(name=name)
+    finally:
+      resource_tracker.register = register
+
+
+def _packTables(tables):
+  """Concatenate the arrays of a dictionary of tables with (file, object) keys into one data array.
+  Returns data and index of (file, object, table type, field, offset, shape)."""
+  index, arrays, offset = [ ], [ ], 0
+  for (fname, name), table in tables.items():
+    types = [t for t, c in tabletypes.items() if isinstance(table,c)]
+    if not types:
+      raise TypeError("Cannot cache object '%s' of file '%s' of type %s!"%(name,fname,type(table).__name__))
+    for field, array in table.toArrays().items():
+      array = np.asarray(array,dtype=np.float64)
+      index.append((os.path.basename(fname),name,types[0],field,offset,array.shape))
+      arrays.append(array.ravel())
+      offset += array.size
+  data = np.concatenate(arrays) if arrays else np.zeros(0)
+  return data, index
+
+
+class SFCache:
+  """ROOT-free cache of the tables of SF files, stored in a NumPy .npz file, or in a flat binary file
+  (any other extension, e.g. .sfb), which is memory-mapped read-only, so processes share the same pages.
+  All arrays are concatenated into one 'data' array, with an 'index' of (file, object, table type, field, offset, shape).
+  A cache can also be published once into shared memory, and attached to read-only by name from other processes,
+  see SFCache.publish and SFCache.attach, or pass 'shm:<name>' as cache path to the tools."""
+
+  def __init__(self, filename, verbose=False):
+    if not os.path.isfile(filename):
+      raise IOError("Cache file '%s' does not exist!"%(filename))
+    if verbose:
+      print("Opening cache '%s'..."%(filename))
+    if filename.endswith('.npz'):
+      with np.load(filename) as npzfile:
+        data  = npzfile['data']
+        index = json.loads(npzfile['index'].tobytes().decode('utf-8'))
+    else:
+      data, index = _mapFlat(filename)
+    self._setData(filename,data,index)
+
+  def _setData(self, filename, data, index):
+    """Set index of arrays from the data array."""
+    self.filename = filename
+    self.index    = OrderedDict() # (file, object) -> (table type, arrays)
+    self.tables   = { } # (file, object) -> table, created on first use
+    self.shm      = None # shared memory block, if published or attached
+    self.owner    = False # whether this process created the shared memory block
+    for fname, name, ttype, field, offset, shape in index:
+      size = 1
+      for n in shape:
+        size *= n
+      self.index.setdefault((fname,name),(ttype,{ }))[1][field] = data[offset:offset+size].reshape(shape)
+
+  def get(self, filename, name):
+    """Get table of an object in a given file."""
+    key = (os.path.basename(filename),name)
+    if key not in self.tables:
+      if key not in self.index:
+        raise IOError("Did not find object '%s' of file '%s' in cache '%s'!"%(name,key[0],self.filename))
+      ttype, arrays = self.index[key]
+      self.tables[key] = tabletypes[ttype].fromArrays(arrays,name=name)
+    return self.tables[key]
+
+  def getTables(self):
+    """Return dictionary of all tables with (file, object) keys."""
+    return OrderedDict((key,self.get(*key)) for key in self.index)
+
+  @classmethod
+  def publish(cls, tables, name=None, verbose=False):
+    """Copy a cache (SFCache or path), or a dictionary of tables with (file, object) keys, once into a new block
+    of shared memory in the flat binary format. Returns the SFCache that owns the block: keep it alive while
+    other processes use it, and call close() at the end to free the block. Workers attach by cache.name."""
+    if not isinstance(tables,dict):
+      tables = getCache(tables,verbose=verbose).getTables()
+    data, index = _packTables(tables)
+    header = _flatHeader(index)
+    data   = np.ascontiguousarray(data,dtype='<f8')
+    shm    = _sharedMemory(name,size=max(1,len(header)+data.nbytes))
+    shm.buf[:len(header)] = header
+    np.frombuffer(shm.buf,dtype='<f8',count=data.size,offset=len(header))[:] = data
+    if verbose:
+      print(">>> Published %d tables (%d bytes) to shared memory '%s'..."%(len(tables),shm.size,shm.name))
+    self = cls._fromShared(shm,owner=True)
+    _caches[self.filename] = self # so 'shm:<name>' reuses it in this process
+    return self
+
+  @classmethod
+  def attach(cls, name, verbose=False):
+    """Attach read-only to a cache published into shared memory by another process, without copying."""
+    if verbose:
+      print("Attaching to shared cache '%s'..."%(name))
+    return cls._fromShared(_sharedMemory(name),owner=False)
+
+  @classmethod
+  def _fromShared(cls, shm, owner=False):
+    pos = [0]
+    def read(n):
+      chunk = bytes(shm.buf[pos[0]:pos[0]+n])
+      pos[0] += n
+      return chunk
+    index, offset = _readFlatHeader(read,shm.name)
+    size = 0
+    for entry in index:
+      n = 1
+      for s in entry[5]:
+        n *= s
+      size = max(size,entry[4]+n)
+    data = np.frombuffer(shm.buf,dtype='<f8',count=size,offset=offset)
+    data.flags.writeable = False
+    self = cls.__new__(cls)
+    self._setData('shm:'+shm.name,data,index)
+    self.shm, self.owner = shm, owner
+    return self
+
+  @property
+  def name(self):
+    """Name of the shared memory block, or None."""
+    return self.shm.name if self.shm is not None else None
+
+  def close(self):
+    """Detach from the shared memory block, and free it if this process published it.
+    Tables of this cache may not be used anymore afterwards."""
+    if self.shm is None:
+      return
+    self.index.clear()
+    self.tables.clear()
+    for key in [k for k in _registry if k[0]==self.filename]:
+      del _registry[key]
+    _caches.pop(self.filename,None)
+    shm, self.shm = self.shm, None
+    shm.close()
+    if self.owner:
+      shm.unlink()
+
+  @staticmethod
+  def write(tables, filename, verbose=False):
+    """Write dictionary of tables with (file, object) keys to a .npz file, or a flat binary file for other extensions."""
+    data, index = _packTables(tables)
+    if verbose:
+      print(">>> Writing %d tables to cache '%s'..."%(len(tables),filename))
+    if filename.endswith('.npz'):
+      np.savez(filename,data=data,index=np.frombuffer(json.dumps(index).encode('utf-8'),dtype=np.uint8))
+    else:
+      _writeFlat(filename,data,index)
+
+
+def compileCache(filenames, cachename, verbose=False):
+  """Read all objects in a list of ROOT files and write them to a ROOT-free cache.
+  Files that are not ROOT files are read as caches, e.g. to convert a .npz cache into a flat binary one."""
+  tables = OrderedDict()
+  for filename in filenames:
+    if filename.endswith('.root'):
+      for name, table in readTables(filename,verbose=verbose).items():
+        tables[(os.path.basename(filename),name)] = table
+    else:
+      tables.update(SFCache(filename,verbose=verbose).getTables())
+  SFCache.write(tables,cachename,verbose=verbose)
+  return SFCache(cachename)
+
+
+_registry = { } # memoized tables: (source, file, object) -> table
+_caches   = { } # memoized caches: path -> SFCache
+_used     = weakref.WeakSet() # all caches that tables were loaded from, incl. SFCache objects given to the tools
+
+
+def _cacheKey(filename):
+  """Key of a cache in _caches and _registry: 'shm:<name>' for shared memory, else the absolute path."""
+  return filename if filename.startswith('shm:') else os.path.abspath(filename)
+
+
+def getCache(cache, verbose=False):
+  """Return SFCache for a given path, loading each cache file only once.
+  A path 'shm:<name>' attaches to a cache published into shared memory by SFCache.publish."""
+  if isinstance(cache,SFCache):
+    return cache
+  key = _cacheKey(cache)
+  if key not in _caches:
+    _caches[key] = SFCache.attach(cache[4:],verbose=verbose) if cache.startswith('shm:') else SFCache(cache,verbose=verbose)
+  return _caches[key]
+
+
+def freezeTable(table):
+  """Make arrays of a table read-only, so it can be shared safely."""
+  if hasattr(table,'toArrays'):
+    for array in table.toArrays().values():
+      array.flags.writeable = False
+  return table
+
+
+def loadTables(filename, names, cache=None, verbose=False):
+  """Load list of tables from a ROOT file, or from a cache, given as SFCache or path to a .npz or flat binary file.
+  Tables are memoized per source, file and object, and shared between all tools. Use clearTables to evict them."""
+  if cache is None:
+    source, fname = None, os.path.abspath(filename)
+  else:
+    cache  = getCache(cache,verbose=verbose)
+    source = _cacheKey(cache.filename)
+    _used.add(cache)
+    fname  = os.path.basename(filename)
+  missing = [name for name in names if (source,fname,name) not in _registry]
+  if missing:
+    if cache is None:
+      tables = readTables(filename,missing,verbose=verbose)
+    else:
+      tables = OrderedDict((name,cache.get(filename,name)) for name in missing)
+    for name, table in tables.items():
+      _registry[(source,fname,name)] = freezeTable(table)
+  elif verbose:
+    print(">>> Reusing tables %s of '%s'..."%(', '.join(names),filename))
+  return [_registry[(source,fname,name)] for name in names]
+
+
+def clearTables(filename=None):
+  """Evict memoized tables of a given file, or all tables and caches if no file is given.
+  The tables are also evicted from the caches, so they are created anew on the next use."""
+  caches = list(_caches.values())+list(_used)
+  if filename is None:
+    for cache in caches:
+      cache.tables.clear()
+    _registry.clear()
+    _caches.clear()
+    return
+  fnames = [os.path.abspath(filename),os.path.basename(filename)]
+  for key in list(_registry.keys()):
+    if key[1] in fnames:
+      del _registry[key]
+  for cache in caches:
+    for key in list(cache.tables.keys()):
+      if key[0]==fnames[1]:
+        del cache.tables[key]
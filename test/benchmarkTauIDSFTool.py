@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# Description: Benchmark the per-call latency and batch throughput of the SF tools
+#              for all campaigns, IDs and WPs on synthetic taus
+# Usage:
+#   ./test/benchmarkTauIDSFTool.py -o benchmark.json
+#   ./test/benchmarkTauIDSFTool.py -y UL2018 -r benchmark.json -t 0.2
+#   ./test/benchmarkTauIDSFTool.py -c data/TauIDSFs.npz -n 100000
+from __future__ import print_function
+import sys, json, platform
+from timeit import default_timer as timer
+from argparse import ArgumentParser
+import numpy as np
+from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool, TauFESTool, campaigns
+parser = ArgumentParser()
+parser.add_argument('-y', '--year', dest='years', nargs='+', default=campaigns,
+                                help="campaigns to benchmark, default: all" )
+parser.add_argument('-n', '--ntaus', type=int, default=1000000,
+                                help="number of taus per batch call, default: %(default)s" )
+parser.add_argument('-N', '--ncalls', type=int, default=2000,
+                                help="number of scalar calls to measure the latency, default: %(default)s" )
+parser.add_argument('-R', '--repeat', type=int, default=5,
+                                help="number of repeated measurements, the fastest is kept, default: %(default)s" )
+parser.add_argument('-u', '--unc', default=None, choices=['Up','Down','All'],
+                                help="uncertainty variation to evaluate, default: nominal" )
+parser.add_argument('-c', '--cache', default=None,
+                                help="read SFs from this ROOT-free cache instead of the ROOT files" )
+parser.add_argument('-s', '--seed', type=int, default=1,
+                                help="seed of the synthetic taus, default: %(default)s" )
+parser.add_argument('-o', '--output', default=None,
+                                help="write results to this JSON file" )
+parser.add_argument('-r', '--reference', default=None,
+                                help="compare results to this JSON file of an earlier run" )
+parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                                help="maximum relative slowdown w.r.t. the reference, default: %(default)s" )
+parser.add_argument('-v', '--verbose', action='store_true',
+                                help="print skipped configurations" )
+args = parser.parse_args()
+
+WPs = ['VVVLoose','VVLoose','VLoose','Loose','Medium','Tight','VTight','VVTight']
+tauIDs_pt  = ['MVAoldDM2017v2','DeepTau2017v2p1VSjet']
+tauIDs_eta = ['antiMu3','antiEleMVA6','DeepTau2017v2p1VSmu','DeepTau2017v2p1VSe']
+tauESs     = ['MVAoldDM2017v2','DeepTau2017v2p1VSjet']
+
+def green(string,**kwargs): return "\x1b[0;32;40m%s\033[0m"%string
+def red(string,**kwargs):   return "\x1b[0;31;40m%s\033[0m"%string
+
+def generateTaus(ntaus,seed=1):
+  """Generate a synthetic sample of taus with a falling pT spectrum, and realistic mix of DMs and genmatches."""
+  rng  = np.random.RandomState(seed)
+  taus = {
+    'pt':       18.+rng.exponential(35.,ntaus),
+    'eta':      rng.uniform(-2.3,2.3,ntaus),
+    'dm':       rng.choice([0,1,2,5,6,10,11],ntaus,p=[.20,.45,.05,.02,.03,.15,.10]),
+    'genmatch': rng.choice([1,2,3,4,5,6],ntaus,p=[.05,.05,.05,.05,.70,.10]),
+  }
+  return taus
+
+def iterConfigs(years):
+  """Yield all tools with the method to benchmark and the names of its arguments."""
+  for year in years:
+    for id in tauIDs_pt:
+      for emb in [False,True]:
+        for dm in [False,True]:
+          for wp in WPs:
+            tool = makeTool(TauIDSFTool,year,id,wp,dm=dm,emb=emb,cache=args.cache)
+            if tool is None: continue
+            if dm:
+              yield (tool,'getSFvsDM',['pt','dm','genmatch'],year,id,wp,emb)
+            else:
+              yield (tool,'getSFvsPT',['pt','genmatch'],year,id,wp,emb)
+    for id in tauIDs_eta:
+      for wp in WPs:
+        tool = makeTool(TauIDSFTool,year,id,wp,cache=args.cache)
+        if tool is None: continue
+        yield (tool,'getSFvsEta',['eta','genmatch'],year,id,wp,False)
+    for id in tauESs:
+      tool = makeTool(TauESTool,year,id,cache=args.cache)
+      if tool is None: continue
+      yield (tool,'getTES',['pt','dm','genmatch'],year,id,None,False)
+      yield (tool,'getTES_highpt',['dm','genmatch'],year,id,None,False)
+    tool = makeTool(TauFESTool,year,cache=args.cache)
+    if tool is not None:
+      yield (tool,'getFES',['eta','dm','genmatch'],year,'DeepTau2017v2p1VSe',None,False)
+
+def makeTool(tool,*toolargs,**kwargs):
+  """Create tool, or return None if its SFs are not available."""
+  try:
+    return tool(*toolargs,**kwargs)
+  except IOError as error:
+    if args.verbose:
+      print(">>> Skipping %s%r: %s"%(tool.__name__,toolargs,error))
+    return None
+
+def measureLatency(method,inputs,ncalls,repeat=3):
+  """Return the fastest average time of a scalar call in seconds."""
+  calls = list(zip(*[x[:ncalls].tolist() for x in inputs]))
+  best  = float('inf')
+  for i in range(repeat):
+    start = timer()
+    for call in calls:
+      method(*call,unc=args.unc)
+    best = min(best,(timer()-start)/len(calls))
+  return best
+
+def measureThroughput(method,inputs,repeat=3):
+  """Return the highest number of taus per second of a batch call."""
+  best = float('inf')
+  for i in range(repeat):
+    start = timer()
+    method(*inputs,unc=args.unc)
+    best = min(best,timer()-start)
+  return len(inputs[0])/best
+
+def getKey(result):
+  return ':'.join(str(result[k]) for k in ['tool','method','year','id','wp','emb'])
+
+def compare(results,reference,threshold):
+  """Compare to the results of an earlier run, and return the list of regressions."""
+  refs = { getKey(r): r for r in reference['results'] }
+  regressions = [ ]
+  for result in results:
+    ref = refs.get(getKey(result),None)
+    if ref is None: continue
+    if result['latency']>(1.+threshold)*ref['latency']:
+      regressions.append((getKey(result),'latency',ref['latency'],result['latency']))
+    if result['throughput']<(1.-threshold)*ref['throughput']:
+      regressions.append((getKey(result),'throughput',ref['throughput'],result['throughput']))
+  return regressions
+
+def main():
+  start   = timer()
+  taus    = generateTaus(args.ntaus,args.seed)
+  results = [ ]
+  print(">>> %-12s %-14s %-15s %-22s %-12s %12s %12s"%(
+        "tool","method","year","id","wp","latency [us]","taus/s"))
+  for tool, mname, argnames, year, id, wp, emb in iterConfigs(args.years):
+    method  = getattr(tool,mname)
+    inputs  = [taus[a] for a in argnames]
+    latency = measureLatency(method,inputs,args.ncalls,args.repeat)
+    rate    = measureThroughput(method,inputs,args.repeat)
+    result  = { 'tool': tool.__class__.__name__, 'method': mname, 'year': year, 'id': id,
+                'wp': wp, 'emb': emb, 'latency': latency, 'throughput': rate }
+    results.append(result)
+    print(">>> %-12s %-14s %-15s %-22s %-12s %12.2f %12.4g"%(
+          result['tool'],mname,year,id,(wp or '')+('_EMB' if emb else ''),1e6*latency,rate))
+  output = {
+    'meta': { 'python': platform.python_version(), 'numpy': np.__version__,
+              'ntaus': args.ntaus, 'ncalls': args.ncalls, 'unc': args.unc, 'cache': args.cache },
+    'results': results,
+  }
+  if args.output:
+    with open(args.output,'w') as file:
+      json.dump(output,file,indent=1)
+    print(">>> Wrote %d results to %s"%(len(results),args.output))
+  failed = False
+  if args.reference:
+    with open(args.reference) as file:
+      reference = json.load(file)
+    for key in ['ntaus','ncalls','unc','cache']:
+      if reference['meta'].get(key)!=output['meta'][key]:
+        print(">>> Warning! Reference was run with %s=%r instead of %r..."%(key,reference['meta'].get(key),output['meta'][key]))
+    regressions = compare(results,reference,args.threshold)
+    for key, var, ref, new in regressions:
+      print(red(">>> Regression in %s of %s: %.4g -> %.4g"%(var,key,ref,new)))
+    if regressions:
+      print(red(">>> Found %d regressions beyond %.0f%% w.r.t. %s!"%(len(regressions),100*args.threshold,args.reference)))
+      failed = True
+    else:
+      print(green(">>> No regressions beyond %.0f%% w.r.t. %s"%(100*args.threshold,args.reference)))
+  print(">>> Done after %.1f seconds"%(timer()-start))
+  return int(failed)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,16 +1,21 @@
-from TauPOG.TauIDSFs.ScoreSFTool import ScoreSFTool
+from TauPOG.TauIDSFs.ScoreSFTool import ScoreSFTool, Hist1D
+from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, campaigns
+from TauPOG.TauIDSFs.sftables import compileTF1, SFCache
+from TauPOG.TauIDSFs.helpers import LazyModule
 from collections import OrderedDict
-from array import array
+from multiprocessing import Pool
 import argparse
-import ROOT
-import copy
 import json
+import time
 import os
+ROOT = LazyModule('ROOT',setup=lambda ROOT: ROOT.gROOT.SetBatch(1)) # import ROOT only when needed, not before forking
 
 ### Example commands ###
 
 # python test/runTauIDScoreCorrections.py --mc_eff="data/MCEffTauIDScoreCorrections_DM.root" --sf="data/TauID_SF_dm_DeepTau2017v2p1VSjet_2017ReReco.root" --var_name="Decay Mode" --output_folder="score_reweighting_example_DM" --name="TauIDScoreSF_DM.root"
 # python test/runTauIDScoreCorrections.py --mc_eff="data/MCEffTauIDScoreCorrections_pT.root" --sf="data/TauID_SF_pt_DeepTau2017v2p1VSjet_2017ReReco.root" --var_name="p_{T}" --output_folder="score_reweighting_example_pT" --name="TauIDScoreSF_pT.root" --logx
+# python test/runTauIDScoreCorrections.py --campaigns all --params pt dm --emb --output_folder="score_reweighting" --name="TauIDScoreSF.root" -j 8
+# python test/runTauIDScoreCorrections.py --campaigns all --params pt dm --emb --output_folder="score_reweighting" --name="TauIDScoreSF.root" -j 8 --plots none
 
 ### Parsers ###
 
@@ -20,116 +25,258 @@ parser.add_argument('--mc_eff',help= 'The name and location of the tau ID MC eff
 parser.add_argument('--wp_scores',help= 'The name and location of the json file with the WP to score conversion in', default='data/TauID_WPtoScore_DeepTau2017v2p1VSjet.json')
 parser.add_argument('--var_name',help= 'Variable name for plotting', default='p_{T}')
 parser.add_argument('--output_folder',help= 'Name of output folder for plots and root file', default='.')
-parser.add_argument('--name',help= 'Name of output root file', default='TauIDScore_SF.root')
+parser.add_argument('--name',help= 'Name of output root file, in batch mode with the campaign appended', default='TauIDScore_SF.root')
 parser.add_argument("--logx",help="Use logx for plots with variable on x axis",action='store_true')
-args = parser.parse_args()
+parser.add_argument('--plots',help= 'Plot mode: draw each plot right away (draw), skip all plots (none), draw them after the calculation with --plot_procs processes (defer), or into one multi-page plots.pdf (pdf)', choices=['draw','none','defer','pdf'], default='draw')
+parser.add_argument('--plot_procs',help= 'Number of processes to draw the plots in defer mode', type=int, default=1)
+parser.add_argument('--spline',help= 'Also fit splines to the score dependent SFs, and write them to a table for smooth evaluation', action='store_true')
+parser.add_argument('--campaigns',help= 'Batch mode: run all combinations of these campaigns (or all) and parameterisations in parallel', nargs='+', choices=campaigns+['all'], default=None)
+parser.add_argument('--params',help= 'Batch mode: SF parameterisations to run', nargs='+', choices=['pt','dm'], default=['pt','dm'])
+parser.add_argument('--emb',help= 'Batch mode: also run the SFs for embedded samples, where available', action='store_true')
+parser.add_argument('--id',help= 'Batch mode: tau ID', default='DeepTau2017v2p1VSjet')
+parser.add_argument('--datapath',help= 'Batch mode: folder with the tau ID scale factor files', default='data')
+parser.add_argument('--mc_eff_pt',help= 'Batch mode: MC efficiency file for the pT parameterisation', default='data/MCEffTauIDScoreCorrections_pT.root')
+parser.add_argument('--mc_eff_dm',help= 'Batch mode: MC efficiency file for the DM parameterisation', default='data/MCEffTauIDScoreCorrections_DM.root')
+parser.add_argument('-j','--nprocs',help= 'Batch mode: number of processes, default: number of cores', type=int, default=None)
 
 ### functions ###
 
-def RemoveSameBins(hist):
-  non_zero_diff_bins = []
-  for i in range(1, hist.GetNbinsX()+1):
-    if not (hist.GetBinContent(i) == 0 or hist.GetBinContent(i) == hist.GetBinContent(i-1)):
-      non_zero_diff_bins.append(hist.GetBinLowEdge(i))
-  non_zero_diff_bins.append(1000)
-  bins = array('f', map(float,non_zero_diff_bins))
-  hout = ROOT.TH1D('hout','',len(bins)-1, bins)
-  for i in range(0,hout.GetNbinsX()+1):
-    hout.SetBinContent(i,hist.GetBinContent(hist.FindBin(hout.GetBinLowEdge(i))))
-  return hout
-
-### Make output directory ###
-
-if not os.path.isdir(args.output_folder): os.system("mkdir {}".format(args.output_folder))
-
-### Load in scale factors ###
-
-sf_h = OrderedDict()
-sf_file = ROOT.TFile(args.sf)
-for ind, key in enumerate(sf_file.GetListOfKeys()):
-  name = key.GetName()
-  rt = sf_file.Get(name)
-
-  if type(rt) == type(ROOT.TH1F()):
-    sf_h[name] = rt.Clone()
-
-  elif type(rt) == type(ROOT.TF1()):
-    if "_cent" not in name: continue
-    name = name.replace("_cent","")
-    # convert to histogram
-    h = rt.DoCreateHistogram(0,500) # need to find a better way to do this but for now it is fine
-    h = RemoveSameBins(h)
-    h.SetName(name)
-    sf_h[name] = copy.deepcopy(h)
-
-    up = sf_file.Get(name+"_up")
-    up_h = up.DoCreateHistogram(0,500)
-    up_h = RemoveSameBins(up_h)
-
-    for i in range(0,sf_h[name].GetNbinsX()+2): 
-      sf_h[name].SetBinError(i,up_h.GetBinContent(i)-sf_h[name].GetBinContent(i))
-    del up_h
-
-### Load in mc efficiencies ###
-
-mc_eff_h = OrderedDict()
-mc_eff_file = ROOT.TFile(args.mc_eff)
-for key in mc_eff_file.GetListOfKeys(): mc_eff_h[key.GetName()] = copy.deepcopy(mc_eff_file.Get(key.GetName()))
-
-### Load into class ###
-
-ssf = ScoreSFTool()
-
-ssf.InputHistograms(sf_h,"sf")
-ssf.PlotSFs(logx=args.logx,x_label=args.var_name,with_spline=False,folder=args.output_folder)
-ssf.InputHistograms(mc_eff_h,"mc")
-
-### Calculate SFs with respect to the loosest WP ##
-loosest_sf = copy.deepcopy(ssf.GetHistogram("sf",ssf.sorted_wp[0]))
-ssf.ScaleHistogramsByHistogram("sf",copy.deepcopy(loosest_sf),divide=True)
-
-### Get data efficiencies ###
-ssf.CalculateHistograms("data")
-ssf.PlotEfficienciesAndSFs(logx=args.logx,x_label=args.var_name,folder=args.output_folder)
-
-### Convert to WP binned histograms ###
-ssf.ConvertToWPBinnedHistograms(rebin_threshold=0.1)
-
-# Change bin names and plot
-for k, v in ssf.rebinned_bins.iteritems():
-  replace = range(0,len(v))
-  replace = [x+0.5 for x in replace]
-  replace_labels = []
-  for ind, i in enumerate(v):
-    if ind+1 != len(v):
-      replace_labels.append(i+"&!"+v[ind+1])
-    else:
-      replace_labels.append(i)
-
-  ssf.PlotEfficienciesAndSFs(logx=False,ratio_range=[0,2],extra_ratio_line=[0.5,1.5],replace=replace,replace_labels=replace_labels,individual=k,folder=args.output_folder)
-
-### Scale back to full SF and move to score bins ###
-
-ssf.ScaleWPHistogramsByHistogram("sf",loosest_sf)
-with open(args.wp_scores) as json_file: score_dict = json.load(json_file, object_pairs_hook=OrderedDict)
-ssf.ConvertToScoreBinnedHistograms(score_dict)
-#ssf.FitSpline("sf")
-ssf.PlotSFs(x_label="Score",with_spline=False,folder=args.output_folder)
-
-### Get TF2s from histograms ###
-
-cent,up,down = ssf.DumpSFTF2(variation="cent"),ssf.DumpSFTF2(variation="up"),ssf.DumpSFTF2(variation="down")
-print "SF formula:"
-cent.Print("all")
-print "Up variation:"
-up.Print("all")
-print "Down variation:"
-down.Print("all")
-
-### Write to file ###
-fout = ROOT.TFile(args.output_folder+"/"+args.name, 'RECREATE')
-cent.Write()
-up.Write()
-down.Write()
-fout.Close()
-print "Created {}/{}".format(args.output_folder,args.name)
+def ConvertTF1ToHistogram(name,cent,up,xmin=0.,xmax=500.,last_edge=1000.):
+  """
+  Convert the piecewise-constant TF1s of the central SF and its up variation into a Hist1D with the exact
+  bin edges and values of their formulas, and the up variation as error. Leading bins with a zero SF are dropped,
+  as are pieces above xmax, with the last bin extending to last_edge. Consecutive equal bins are merged.
+  """
+  funcs = [compileTF1(cent),compileTF1(up)]
+  bounds = [xmin] + sorted(set(e for f in funcs for e in f.edges.tolist() if xmin < e < xmax)) + [xmax]
+  edges, values = [], []
+  for lo, hi in zip(bounds[:-1],bounds[1:]):
+    vals = []
+    for f in funcs:
+      bin = f.findBin((lo+hi)/2.)
+      if f.slopes[bin] != 0:
+        raise ValueError("{} is not constant between {} and {}!".format(f.name,lo,hi))
+      vals.append(f.intercepts[bin])
+    if not edges and vals[0] == 0: continue # drop leading zero SF
+    if values and vals == values[-1]: continue # merge equal bins
+    edges.append(lo)
+    values.append(vals)
+  edges.append(last_edge)
+  contents = [0.] + [sf for sf, sf_up in values] + [0.]
+  variances = [0.] + [(sf_up-sf)**2 for sf, sf_up in values] + [0.]
+  return Hist1D(name,edges,contents,variances)
+
+def LoadSFs(filename):
+  """
+  Load the tau ID SFs of each WP from a ROOT file as histograms.
+  """
+  sf_h = OrderedDict()
+  sf_file = ROOT.TFile(filename)
+  for ind, key in enumerate(sf_file.GetListOfKeys()):
+    name = key.GetName()
+    rt = sf_file.Get(name)
+
+    if type(rt) == type(ROOT.TH1F()):
+      sf_h[name] = Hist1D.FromTH1(rt)
+
+    elif type(rt) == type(ROOT.TF1()):
+      if "_cent" not in name: continue
+      name = name.replace("_cent","")
+      # convert to histogram with exact bins
+      sf_h[name] = ConvertTF1ToHistogram(name,rt,sf_file.Get(name+"_up"))
+  sf_file.Close()
+  return sf_h
+
+def LoadMCEfficiencies(filename):
+  """
+  Load the MC efficiencies of each WP from a ROOT file as histograms.
+  """
+  mc_eff_h = OrderedDict()
+  mc_eff_file = ROOT.TFile(filename)
+  for key in mc_eff_file.GetListOfKeys(): mc_eff_h[key.GetName()] = Hist1D.FromTH1(mc_eff_file.Get(key.GetName()))
+  mc_eff_file.Close()
+  return mc_eff_h
+
+def RunScoreCorrections(sf,mc_eff,wp_scores,var_name="p_{T}",output_folder=".",logx=False,plots="draw",plot_procs=1,spline=False):
+  """
+  Run the full chain from the WP SFs and MC efficiencies to the score dependent SFs, and make the plots.
+
+  :param sf: Tau ID scale factor file
+  :param mc_eff: Tau ID MC efficiency file
+  :param wp_scores: Json file with the WP to score conversion
+  :param var_name: Variable name for plotting
+  :param output_folder: Output folder for plots
+  :param logx: Use logx for plots with variable on x axis
+  :param plots: Plot mode: draw, none, defer or pdf
+  :param plot_procs: Number of processes to draw the plots in defer mode
+  :param spline: Fit splines to the score dependent SFs
+  :return: ScoreSFTool with the SFs in bins of the variable and score
+  """
+  if not os.path.isdir(output_folder): os.makedirs(output_folder)
+
+  ### Load into class ###
+
+  ssf = ScoreSFTool(plot_mode="defer" if plots=="pdf" else plots)
+
+  ssf.InputHistograms(LoadSFs(sf),"sf")
+  ssf.PlotSFs(logx=logx,x_label=var_name,with_spline=False,folder=output_folder)
+  ssf.InputHistograms(LoadMCEfficiencies(mc_eff),"mc")
+
+  ### Calculate SFs with respect to the loosest WP ##
+  loosest_sf = ssf.GetHistogram("sf",ssf.sorted_wp[0])
+  ssf.ScaleHistogramsByHistogram("sf",loosest_sf,divide=True)
+
+  ### Get data efficiencies ###
+  ssf.CalculateHistograms("data")
+  ssf.PlotEfficienciesAndSFs(logx=logx,x_label=var_name,folder=output_folder)
+
+  ### Convert to WP binned histograms ###
+  ssf.ConvertToWPBinnedHistograms(rebin_threshold=0.1)
+
+  # Change bin names and plot
+  for k, v in ssf.rebinned_bins.iteritems():
+    replace = range(0,len(v))
+    replace = [x+0.5 for x in replace]
+    replace_labels = []
+    for ind, i in enumerate(v):
+      if ind+1 != len(v):
+        replace_labels.append(i+"&!"+v[ind+1])
+      else:
+        replace_labels.append(i)
+
+    ssf.PlotEfficienciesAndSFs(logx=False,ratio_range=[0,2],extra_ratio_line=[0.5,1.5],replace=replace,replace_labels=replace_labels,individual=k,folder=output_folder)
+
+  ### Scale back to full SF and move to score bins ###
+
+  ssf.ScaleWPHistogramsByHistogram("sf",loosest_sf)
+  with open(wp_scores) as json_file: score_dict = json.load(json_file, object_pairs_hook=OrderedDict)
+  ssf.ConvertToScoreBinnedHistograms(score_dict)
+  if spline: ssf.FitSpline("sf")
+  ssf.PlotSFs(x_label="Score",with_spline=spline,folder=output_folder)
+
+  ### Draw deferred plots ###
+  if plots == "pdf":
+    ssf.RenderPlots(pdf=os.path.join(output_folder,"plots.pdf"))
+  elif plots == "defer":
+    ssf.RenderPlots(nprocs=plot_procs)
+  return ssf
+
+def GetJobs(args):
+  """
+  Return list of jobs for all combinations of campaigns, parameterisations and embedded samples,
+  skipping those without a scale factor file, or without SFs for embedded samples for this ID.
+  """
+  jobs = []
+  for campaign in (campaigns if 'all' in args.campaigns else args.campaigns):
+    for param in args.params:
+      for emb in ([False,True] if args.emb else [False]):
+        tag = param+("_EMB" if emb else "")
+        try:
+          sf = TauIDSFTool.getFilename(campaign,args.id,dm=(param=="dm"),emb=emb,path=args.datapath)
+        except IOError as error:
+          if not emb: # unknown ID
+            raise
+          print "WARNING: {}, skipping {} {}".format(str(error).rstrip('!'),campaign,tag)
+          continue
+        if not os.path.isfile(sf):
+          if not emb: # EMB SFs are only available for some campaigns
+            print "WARNING: {} does not exist, skipping {} {}".format(sf,campaign,tag)
+          continue
+        jobs.append({
+          'campaign': campaign, 'tag': tag, 'sf': sf,
+          'mc_eff': args.mc_eff_dm if param=="dm" else args.mc_eff_pt,
+          'wp_scores': args.wp_scores,
+          'var_name': "Decay Mode" if param=="dm" else "p_{T}",
+          'logx': param=="pt",
+          'plots': args.plots,
+          'spline': args.spline,
+          'output_folder': os.path.join(args.output_folder,campaign,tag),
+        })
+  return jobs
+
+def RunJob(job):
+  """
+  Run one job in a worker process, and return the SF formulas and table, which can be sent back to the parent.
+  """
+  start = time.time()
+  ssf = RunScoreCorrections(job['sf'],job['mc_eff'],job['wp_scores'],var_name=job['var_name'],
+                            output_folder=job['output_folder'],logx=job['logx'],plots=job['plots'],spline=job['spline'])
+  formulas = OrderedDict((variation,ssf.GetSFFormula(variation)) for variation in ["cent","up","down"])
+  tables = OrderedDict([(job['tag'],ssf.GetSFTable())])
+  if job['spline']: tables[job['tag']+"_spline"] = ssf.GetSplineTable()
+  return job, formulas, tables, time.time()-start
+
+def RunBatch(jobs,output_folder,name,nprocs=None):
+  """
+  Run jobs in a pool of processes, and write per campaign one ROOT file with the TF2s named <tag>_<variation>,
+  and one cache with the SF table (and spline table <tag>_spline) of each tag, which can be read with SFCache(...).get(<ROOT file>,<tag>).
+  """
+  if not os.path.isdir(output_folder): os.makedirs(output_folder)
+  results = OrderedDict((job['campaign'],OrderedDict()) for job in jobs)
+  pool = Pool(nprocs)
+  try:
+    for i, (job, formulas, tables, dt) in enumerate(pool.imap_unordered(RunJob,jobs)):
+      print ">>> [{}/{}] {} {} done in {:.1f} s".format(i+1,len(jobs),job['campaign'],job['tag'],dt)
+      results[job['campaign']][job['tag']] = (formulas,tables)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+  for campaign, tags in results.iteritems():
+    fname = os.path.join(output_folder,name.replace(".root","")+"_"+campaign+".root")
+    fout = ROOT.TFile(fname,'RECREATE')
+    tables = OrderedDict()
+    for tag in sorted(tags):
+      formulas, tag_tables = tags[tag]
+      for variation, formula in formulas.iteritems():
+        ScoreSFTool.SFFormulaToTF2("{}_{}".format(tag,variation),formula).Write()
+      for key, table in tag_tables.iteritems():
+        tables[(os.path.basename(fname),key)] = table
+    fout.Close()
+    SFCache.write(tables,fname.replace(".root",".npz"))
+    print "Created {} and {} with {}".format(fname,fname.replace(".root",".npz"),", ".join(sorted(tags)))
+
+def RunSingle(args):
+  """
+  Run one SF and MC efficiency file, and write the TF2s and SF table.
+  """
+  ssf = RunScoreCorrections(args.sf,args.mc_eff,args.wp_scores,var_name=args.var_name,
+                            output_folder=args.output_folder,logx=args.logx,plots=args.plots,plot_procs=args.plot_procs,
+                            spline=args.spline)
+
+  ### Get TF2s from histograms ###
+
+  cent,up,down = ssf.DumpSFTF2(variation="cent"),ssf.DumpSFTF2(variation="up"),ssf.DumpSFTF2(variation="down")
+  print "SF formula:"
+  cent.Print("all")
+  print "Up variation:"
+  up.Print("all")
+  print "Down variation:"
+  down.Print("all")
+
+  ### Write to file ###
+  fout = ROOT.TFile(args.output_folder+"/"+args.name, 'RECREATE')
+  cent.Write()
+  up.Write()
+  down.Write()
+  fout.Close()
+  print "Created {}/{}".format(args.output_folder,args.name)
+
+  ### Write SF table for fast evaluation ###
+  table_name = args.output_folder+"/"+args.name.replace(".root","")+".npz"
+  ssf.DumpSFTable(table_name)
+  print "Created {}".format(table_name)
+  if args.spline:
+    spline_name = table_name.replace(".npz","_spline.npz")
+    ssf.DumpSplineTable(spline_name)
+    print "Created {}".format(spline_name)
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  if args.campaigns:
+    RunBatch(GetJobs(args),args.output_folder,args.name,nprocs=args.nprocs)
+  else:
+    RunSingle(args)
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# Description: Check that importing the tools does not pull in ROOT, and stays within an import-time budget
+# Usage:
+#   ./test/testImportTime.py
+#   ./test/testImportTime.py --budget 0.3 -n 10
+#   ./test/testImportTime.py --python python2 # e.g. for ScoreSFTool, which needs Python 2
+from __future__ import print_function
+import sys, subprocess
+from argparse import ArgumentParser
+parser = ArgumentParser()
+parser.add_argument('modules', nargs='*', default=['TauPOG.TauIDSFs.TauIDSFTool','TauPOG.TauIDSFs.sftables','TauPOG.TauIDSFs.helpers',
+                                                   'TauPOG.TauIDSFs.ScoreSFTool'],
+                                help="modules to import, default: %(default)s" )
+parser.add_argument('-b', '--budget', type=float, default=0.5,
+                                help="maximum import time in seconds, default: %(default)s" )
+parser.add_argument('-n', '--ntries', type=int, default=5,
+                                help="number of fresh interpreters per module, the fastest is kept, default: %(default)s" )
+parser.add_argument('-p', '--python', default=sys.executable,
+                                help="python interpreter to import the modules with, default: %(default)s" )
+args = parser.parse_args()
+
+# import in a fresh interpreter, so nothing is cached in sys.modules
+snippet = "import sys, time; t = time.time(); import %s; print('%%.6f %%d'%%(time.time()-t,'ROOT' in sys.modules))"
+
+def green(string,**kwargs): return "\x1b[0;32;40m%s\033[0m"%string
+def red(string,**kwargs):   return "\x1b[0;31;40m%s\033[0m"%string
+
+def measureImport(module,ntries=5,python=sys.executable):
+  """Return the fastest import time of a module in seconds, and whether ROOT got imported.
+  Raises CalledProcessError if the module cannot be imported."""
+  times, hasROOT = [ ], False
+  for i in range(ntries):
+    out = subprocess.check_output([python,'-c',snippet%module])
+    time, root = out.decode().split()[-2:]
+    times.append(float(time))
+    hasROOT = hasROOT or bool(int(root))
+  return min(times), hasROOT
+
+def main():
+  failed = False
+  print(">>> %-32s %10s %6s"%("module","time [ms]","ROOT"))
+  for module in ['numpy']+args.modules:
+    try:
+      time, hasROOT = measureImport(module,args.ntries,args.python)
+    except subprocess.CalledProcessError: # error is printed by the interpreter
+      print(red(">>> %-32s %10s %6s"%(module,"failed","-")))
+      failed = True
+      continue
+    ok = module=='numpy' or (time<=args.budget and not hasROOT)
+    color = green if ok else red
+    print(color(">>> %-32s %10.1f %6s"%(module,1000*time,hasROOT)))
+    failed = failed or not ok
+  if failed:
+    print(red(">>> Import of the tools failed, imported ROOT, or exceeded the budget of %.1f ms!"%(1000*args.budget)))
+  else:
+    print(green(">>> All imports within the budget of %.1f ms without ROOT"%(1000*args.budget)))
+  return int(failed)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -4,7 +4,9 @@
 #   ./test/testTauIDSFTool.py
 from __future__ import print_function
 import time; start0 = time.time()
-from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool, TauFESTool
+import itertools
+import numpy as np
+from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool, TauFESTool, campaigns, workingpoints
 start1 = time.time()
 
 def green(string,**kwargs): return "\x1b[0;32;40m%s\033[0m"%string
@@ -89,6 +91,89 @@ def printFESTable(year):
     print(">>> ")
   
 
+def compareArray(label,scalar,array,variations,*args):
+  """Check that the array method gives the same values as the scalar method, for all combinations of
+  the scalar arguments, and all uncertainties. Returns the number of compared values."""
+  points  = list(itertools.product(*args))
+  columns = [np.array([p[i] for p in points]) for i in range(len(args))]
+  for unc in [None,'Up','Down','All']:
+    expect = np.array([scalar(*(p+(unc,))) for p in points],dtype=np.float64)
+    result = array(*(columns+[unc]))
+    if unc=='All':
+      result = np.stack(result,axis=-1)
+    diff   = ~np.isclose(result,expect,rtol=1e-12,atol=0)
+    if diff.any():
+      i = np.argwhere(diff)[0][0]
+      raise AssertionError("%s: array and scalar values differ for %s, unc=%r: %s vs. %s"%(
+                           label,points[i],unc,result[i],expect[i]))
+  result = variations(*columns)
+  if not all(np.allclose(result[f],expect[:,i],rtol=1e-12,atol=0) for i, f in enumerate(['down','nom','up'])):
+    raise AssertionError("%s: getVariations differs from the scalar values!"%(label))
+  return 4*len(points)
+  
+
+def compareSFArrays(year,id,wp,vs='pt',emb=False,otherVSlepWP=False):
+  """Compare array and scalar tau ID SFs. Returns the number of compared values, or 0 if not available."""
+  try:
+    sftool = TauIDSFTool(year,id,wp,dm=(vs=='dm'),emb=emb,otherVSlepWP=otherVSlepWP)
+  except IOError: # file or WP not available
+    return 0
+  label = "SF for %s WP of %s in %s vs. %s%s%s"%(wp,id,year,vs,' (emb)' if emb else '',' (extraUnc)' if otherVSlepWP else '')
+  ptvals  = [10,20,20.0001,21,25,26,30,31,34,35,40,40.0001,50,70,99.99,100,200,500,600,700,800,1000,1500,2000]
+  gmvals  = [0,1,2,3,4,5,6]
+  if vs=='pt':
+    return compareArray(label,sftool.getSFvsPT,sftool.getSFvsPTArray,sftool.getVariations,ptvals,gmvals)
+  elif vs=='dm':
+    dmvals = [-1,0,1,2,5,6,10,11,12]
+    return compareArray(label,sftool.getSFvsDM,sftool.getSFvsDMArray,sftool.getVariations,ptvals,dmvals,gmvals)
+  etavals = [0,0.2,-0.3,0.5,1.0,1.46,1.5,-1.558,2.0,2.2,2.3,2.4,2.5,3.0]
+  return compareArray(label,sftool.getSFvsEta,sftool.getSFvsEtaArray,sftool.getVariations,etavals,gmvals)
+  
+
+def compareTESArrays(year,id):
+  """Compare array and scalar TES. Returns the number of compared values, or 0 if not available."""
+  try:
+    testool = TauESTool(year,id)
+  except IOError: # file not available
+    return 0
+  label   = "TES for %s in %s"%(id,year)
+  ptvals  = [20,25,34,35,50,99.99,100,102,169.99,170,175,500]
+  dmvals  = [-1,0,1,2,5,10,11,12]
+  gmvals  = [0,1,5,6]
+  nvals   = compareArray(label,testool.getTES,testool.getTESArray,testool.getVariations,ptvals,dmvals,gmvals)
+  nvals  += compareArray(label+" (high pT)",testool.getTES_highpt,testool.getTESArray_highpt,testool.getVariations_highpt,dmvals,gmvals)
+  return nvals
+  
+
+def compareFESArrays(year):
+  """Compare array and scalar FES. Returns the number of compared values."""
+  festool = TauFESTool(year)
+  label   = "FES in %s"%(year)
+  etavals = [0,0.5,-1.0,1.4999,1.5,-1.5,2.0,2.3]
+  dmvals  = [-1,0,1,2,10]
+  gmvals  = [0,1,2,3,5]
+  return compareArray(label,festool.getFES,festool.getFESArray,festool.getVariations,etavals,dmvals,gmvals)
+  
+
+def compareAllArrays():
+  """Compare array and scalar methods for all campaigns, IDs, WPs and options."""
+  tauIDs = [
+    'MVAoldDM2017v2','DeepTau2017v2p1VSjet',
+    'antiEleMVA6','antiMu3','DeepTau2017v2p1VSmu','DeepTau2017v2p1VSe',
+  ]
+  nvals = 0
+  for year in campaigns:
+    for id in tauIDs:
+      vslist = ['eta'] if any(s in id for s in ['anti','VSe','VSmu']) else ['pt','dm']
+      for vs, wp, emb, otherVSlepWP in itertools.product(vslist,workingpoints,[False,True],[False,True]):
+        nvals += compareSFArrays(year,id,wp,vs,emb,otherVSlepWP)
+    for id in ['MVAoldDM2017v2','DeepTau2017v2p1VSjet']:
+      nvals += compareTESArrays(year,id)
+    nvals += compareFESArrays(year)
+  print(">>> ")
+  print(">>> %s"%green("Array and scalar methods agree for %d values"%(nvals)))
+  
+
 if __name__ == "__main__":  
   print(">>> ")
   print(">>> start test tau ID SF tool")
@@ -96,6 +181,7 @@ if __name__ == "__main__":
   testIDTool   = True and False
   testTESTool  = True and False
   testFESTool  = True #and False
+  testArrays   = True #and False
   emb          = True and False
   otherVSlepWP = True and False
   
@@ -139,6 +225,8 @@ if __name__ == "__main__":
         printTESTable(year,id)
     if testFESTool:
       printFESTable(year)
+  if testArrays:
+    compareAllArrays()
   
   start3 = time.time()
   print(">>> ")
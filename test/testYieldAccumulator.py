@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+# Description: Check the yields of YieldAccumulator, and that it refuses energy scales as weights,
+#              also after they were written to .npy files by processFile
+# Usage:
+#   ./test/testYieldAccumulator.py
+#   ./test/testYieldAccumulator.py -y UL2018 -c data/TauIDSFs.npz
+from __future__ import print_function
+import os, sys, shutil, tempfile
+import numpy as np
+from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool, TauFESTool, campaigns
+from TauPOG.TauIDSFs.pipeline import CorrectionStage, YieldAccumulator, processFile
+from TauPOG.TauIDSFs.sftables import isScale
+from argparse import ArgumentParser
+parser = ArgumentParser()
+parser.add_argument('-y', '--year', default='2018ReReco', choices=campaigns,
+                               help="campaign, default: %(default)s" )
+parser.add_argument('-c', '--cache', default=None,
+                               help="read SFs from this ROOT-free cache instead of the ROOT files" )
+args = parser.parse_args()
+
+def green(string,**kwargs): return "\x1b[0;32;40m%s\033[0m"%string
+
+def makeTaus(ntaus=1000,seed=1):
+  """Return dictionary of columns of random taus."""
+  rng = np.random.RandomState(seed)
+  return {
+    'Tau_pt':          rng.uniform(20,200,ntaus),
+    'Tau_eta':         rng.uniform(-2.3,2.3,ntaus),
+    'Tau_decayMode':   rng.choice([0,1,10,11],ntaus),
+    'Tau_genPartFlav': rng.choice([0,1,3,5],ntaus),
+  }
+
+def categorize(pt):
+  """Simple categories in tau pt, -1 to skip taus below 30 GeV."""
+  return np.digitize(pt,[30,50,100])-1
+
+def assertRaises(error,func,*args,**kwargs):
+  try:
+    func(*args,**kwargs)
+  except error:
+    return
+  raise AssertionError("%s did not raise %s!"%(func.__name__,error.__name__))
+
+def testYields(taus,sftool,testool):
+  """Compare the yields to a direct computation, including shifted categories for the TES."""
+  idsf = sftool.getVariations(taus['Tau_pt'],taus['Tau_genPartFlav'])
+  tes  = testool.getVariations(taus['Tau_pt'],taus['Tau_decayMode'],taus['Tau_genPartFlav'])
+  pt, weight = taus['Tau_pt'], np.linspace(0.5,1.5,len(taus['Tau_pt']))
+  shifted    = { 'tes_down': categorize(pt*tes['down']), 'tes_up': categorize(pt*tes['up']) }
+  acc = YieldAccumulator(3)
+  for chunk in [slice(0,400),slice(400,None)]:
+    acc.fill(categorize(pt[chunk]),{'idsf': idsf[chunk]},weight=weight[chunk],
+             shifted_categories={k: v[chunk] for k, v in shifted.items()})
+  def expect(cat,w):
+    return np.array([w[cat==i].sum() for i in range(3)])
+  nominal = weight*idsf['nom']
+  assert np.allclose(acc.sumw['nom'],expect(categorize(pt),nominal))
+  assert np.allclose(acc.sumw2['nom'],expect(categorize(pt),nominal**2))
+  assert np.allclose(acc.sumw['idsf_up'],expect(categorize(pt),weight*idsf['up']))
+  assert np.allclose(acc.sumw['tes_down'],expect(shifted['tes_down'],nominal))
+  assert np.allclose(acc.sumw['tes_up'],expect(shifted['tes_up'],nominal))
+  assertRaises(TypeError,acc.fill,categorize(pt),{'idsf': idsf,'tes': tes})
+  assertRaises(ValueError,acc.fill,categorize(pt),{'idsf': idsf},shifted_categories={'idsf_up': categorize(pt)})
+  print(">>> %s"%green("Yields with shifted categories agree"))
+
+def testStoredScales(taus,sftool,testool,festool):
+  """Write the corrections with processFile, read them back, and check that fill still refuses energy scales."""
+  stage = CorrectionStage()
+  stage.add('idsf',sftool.getVariations,['Tau_pt','Tau_genPartFlav'])
+  stage.add('tes',testool.getVariations,['Tau_pt','Tau_decayMode','Tau_genPartFlav'])
+  stage.add('fes',festool.getVariations,['Tau_eta','Tau_decayMode','Tau_genPartFlav'])
+  outdir = tempfile.mkdtemp()
+  try:
+    processFile(stage,taus,outdir,chunksize=300)
+    columns = { n: np.load(os.path.join(outdir,n+'.npy')) for n in ['idsf','tes','fes'] }
+    np.savez(os.path.join(outdir,'weights.npz'),**columns)
+    with np.load(os.path.join(outdir,'weights.npz')) as npzfile:
+      columns.update({ n+'_npz': npzfile[n] for n in ['idsf','tes','fes'] })
+  finally:
+    shutil.rmtree(outdir)
+  category = categorize(taus['Tau_pt'])
+  for name, values in columns.items():
+    assert isScale(values)==(not name.startswith('idsf')), "Wrong energy scale flag for %s!"%(name)
+    if isScale(values):
+      assertRaises(TypeError,YieldAccumulator(3).fill,category,{name: values})
+    else:
+      YieldAccumulator(3).fill(category,{name: values})
+  assert np.array_equal(columns['tes']['nom'],testool.getVariations(taus['Tau_pt'],taus['Tau_decayMode'],
+                                                                    taus['Tau_genPartFlav'])['nom'])
+  print(">>> %s"%green("Energy scales stored in .npy and .npz files are refused as weights"))
+
+if __name__ == "__main__":
+  taus    = makeTaus()
+  sftool  = TauIDSFTool(args.year,'DeepTau2017v2p1VSjet','Medium',cache=args.cache)
+  testool = TauESTool(args.year,cache=args.cache)
+  festool = TauFESTool(args.year,cache=args.cache)
+  testYields(taus,sftool,testool)
+  testStoredScales(taus,sftool,testool,festool)
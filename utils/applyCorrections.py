@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# Description: Apply the tau ID SFs, TES and FES to many files of tau columns in parallel
+# Usage:
+#   ./utils/applyCorrections.py taus_*.npz -y UL2018 -w Medium -o weights/
+#   ./utils/applyCorrections.py taus_*.npz -y UL2018 -w Medium --tes --fes --counts nTau -j 16 -c data/TauIDSFs.npz
+#   ./utils/applyCorrections.py taus_*.npz -y UL2018 -w Medium -j 16 -c data/TauIDSFs.npz --shared
+from __future__ import print_function
+import os
+from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool, TauFESTool, campaigns
+from TauPOG.TauIDSFs.pipeline import CorrectionStage, processFiles
+from TauPOG.TauIDSFs.sftables import SFCache
+from argparse import ArgumentParser
+parser = ArgumentParser()
+parser.add_argument('sources', nargs='+',
+                               help="input .npz files, .npy files, or directories of .npy files with tau columns" )
+parser.add_argument('-o', '--outdir', default='.',
+                               help="output directory, with one subdirectory of .npy files per source, default: %(default)s" )
+parser.add_argument('-y', '--year', required=True, choices=campaigns,
+                               help="campaign" )
+parser.add_argument('-i', '--id', default='DeepTau2017v2p1VSjet',
+                               help="tau ID, default: %(default)s" )
+parser.add_argument('-w', '--wp', default='Medium',
+                               help="tau ID WP, default: %(default)s" )
+parser.add_argument('--dm', action='store_true',
+                               help="use DM-dependent tau ID SFs" )
+parser.add_argument('--emb', action='store_true',
+                               help="use tau ID SFs for embedded samples" )
+parser.add_argument('--tes', action='store_true',
+                               help="also evaluate the tau energy scale" )
+parser.add_argument('--fes', action='store_true',
+                               help="also evaluate the e -> tau fake energy scale" )
+parser.add_argument('-c', '--cache', default=None,
+                               help="read SFs from this ROOT-free cache instead of the ROOT files" )
+parser.add_argument('--shared', action='store_true',
+                               help="publish the cache into shared memory once, and let the tools attach to it (Python 3.8+)" )
+parser.add_argument('--counts', default=None,
+                               help="column with number of taus per event (e.g. nTau), to compute event weights" )
+parser.add_argument('--pt', default='Tau_pt',
+                               help="tau pt column, default: %(default)s" )
+parser.add_argument('--eta', default='Tau_eta',
+                               help="tau eta column, default: %(default)s" )
+parser.add_argument('--decaymode', default='Tau_decayMode',
+                               help="tau decay mode column, default: %(default)s" )
+parser.add_argument('--genmatch', default='Tau_genPartFlav',
+                               help="tau genmatch column, default: %(default)s" )
+parser.add_argument('-j', '--nprocs', type=int, default=None,
+                               help="number of processes, default: number of cores" )
+parser.add_argument('-n', '--chunksize', type=int, default=100000,
+                               help="number of rows (or events with --counts) per chunk, default: %(default)s" )
+parser.add_argument('-q', '--quiet', action='store_true',
+                               help="do not print progress" )
+args = parser.parse_args()
+if args.shared and not args.cache:
+  parser.error("--shared needs a cache (-c)")
+
+def makeStage(cache):
+  """Create tools (and load their tables) once, before the workers are forked."""
+  stage  = CorrectionStage(counts=args.counts)
+  sftool = TauIDSFTool(args.year,args.id,args.wp,dm=args.dm,emb=args.emb,cache=cache)
+  if args.dm:
+    stage.add('idsf',sftool.getVariations,[args.pt,args.decaymode,args.genmatch],event=bool(args.counts))
+  elif any(s in args.id for s in ['anti','VSe','VSmu']):
+    stage.add('idsf',sftool.getVariations,[args.eta,args.genmatch],event=bool(args.counts))
+  else:
+    stage.add('idsf',sftool.getVariations,[args.pt,args.genmatch],event=bool(args.counts))
+  if args.tes:
+    if args.id in ['MVAoldDM2017v2','DeepTau2017v2p1VSjet']: # TES is measured for the VSjet IDs only
+      testool = TauESTool(args.year,args.id,cache=cache)
+    else:
+      testool = TauESTool(args.year,cache=cache)
+    stage.add('tes',testool.getVariations,[args.pt,args.decaymode,args.genmatch])
+  if args.fes:
+    festool = TauFESTool(args.year,cache=cache)
+    stage.add('fes',festool.getVariations,[args.eta,args.decaymode,args.genmatch])
+  return stage
+
+def getOutput(source):
+  """Output directory of a source."""
+  name = os.path.basename(source.rstrip(os.sep))
+  for ext in ['.npz','.npy']:
+    if name.endswith(ext):
+      name = name[:-len(ext)]
+  return os.path.join(args.outdir,name)
+
+if __name__ == "__main__":
+  shared  = SFCache.publish(args.cache,verbose=not args.quiet) if args.shared else None
+  try:
+    stage   = makeStage('shm:'+shared.name if shared else args.cache)
+    outputs = [getOutput(s) for s in args.sources]
+    processFiles(stage,args.sources,outputs,nprocs=args.nprocs,chunksize=args.chunksize,verbose=not args.quiet)
+  finally:
+    if shared:
+      shared.close()
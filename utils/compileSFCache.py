@@ -0,0 +1,32 @@
+#! /usr/bin/env python
+# Description: Compile the SF files into a ROOT-free cache, so the tools can be used without importing ROOT
+# Usage:
+#   ./utils/compileSFCache.py
+#   ./utils/compileSFCache.py data/TauID_SF_*.root -o TauIDSFs.npz
+#   ./utils/compileSFCache.py data/TauIDSFs.npz -o data/TauIDSFs.sfb # convert to memory-mappable file
+from __future__ import print_function
+import os, glob
+from argparse import ArgumentParser
+if 'CMSSW_BASE' in os.environ: # assume CMSSW environment
+  from TauPOG.TauIDSFs.sftables import compileCache
+  datapath = os.path.join(os.environ['CMSSW_BASE'],"src/TauPOG/TauIDSFs/data")
+else: # assume PYTHONPATH points to the python directory
+  from sftables import compileCache
+  if 'TAUIDSFs' in os.environ:
+    datapath = os.path.join(os.environ['TAUIDSFs'],"data")
+  else: # data directory of this package
+    datapath = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","data"))
+parser = ArgumentParser()
+parser.add_argument('filenames', nargs='*', default=sorted(glob.glob(os.path.join(datapath,"*.root"))),
+                                 help="TauPOG root files (or caches) to compile, default: all in %s"%(datapath) )
+parser.add_argument('-o', '--output', default=os.path.join(datapath,"TauIDSFs.npz"),
+                                 help="output cache file, .npz or flat binary for other extensions (e.g. .sfb), default: %(default)s" )
+parser.add_argument('-v', '--verbose', action='store_true',
+                                 help="print file names" )
+args = parser.parse_args()
+if not args.filenames:
+  parser.error("Did not find any files to compile in %s!"%(datapath))
+
+if __name__ == "__main__":
+  cache = compileCache(args.filenames,args.output,verbose=args.verbose)
+  print(">>> Compiled %d objects from %d files into %s"%(len(cache.index),len(args.filenames),args.output))